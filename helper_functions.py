@@ -11,15 +11,31 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 # For creating DataFrame objects
 import pandas as pd
+# For combining categorical columns without converting them to objects
+from pandas.api.types import union_categoricals
 # For searching and listing directories
 import os
 # For matching regular expressions
 import re
+# For labelling subplots with letters
+import string
 # For formatting date objects
 import datetime
+# For parsing text or files that have already been read in
+from io import StringIO, BytesIO, TextIOWrapper
+# For reading in data files in parallel, and reading files ahead of parsing them
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque, OrderedDict
+# For timing how long is spent waiting to read files
+import time
+# For naming the cached gridded data after the data sources and filters
+import hashlib
 # For reading the ITP `cormat` files
-import mat73
+#   v7.3 files are HDF5 so h5py can read individual variables from them
+import h5py
 from scipy import io
+# For finding the profiles within a region
+from scipy.spatial import cKDTree
 
 """
 To install Cartopy and its dependencies, follow:
@@ -31,9 +47,33 @@ $ conda install -c conda-forge cartopy
 import cartopy.crs as ccrs
 import cartopy.feature
 
+# For finding density, N2, and other derived quantities using TEOS-10
+#   $ conda install -c conda-forge gsw
+import gsw
+
 ################################################################################
 # This is the location of the data on your computer
 science_data_file_path = '/Users/Grey/Documents/Research/Science_Data/'
+# This is where parsed data will be cached on your computer
+#   Reading and writing the cache requires `pyarrow`
+#   $ conda install -c conda-forge pyarrow
+#   The data of each instrument is stored as flat arrays of temp, salt, and p
+#   in `.npy` files which are memory-mapped, see `write_ragged_store`
+cache_file_path = science_data_file_path+'Cached_Data/'
+# Set to False to always re-parse the original data files
+use_cache = True
+# The number of data files to read ahead of the parser with a pool of threads,
+#   which keeps the parser busy when the data is on a network drive where
+#   opening each file is slow. Each file read ahead is read in whole, even when
+#   only part of it is needed, so leave this at 0 to only read each file as
+#   it's parsed, which is best for data on a local disk
+prefetch_depth = 0
+# The number of profiles in each block of cached gridded data, see
+#   `iter_gridded_chunks`
+grid_chunk_size = 1000
+# The most memory, in MB, that data kept in memory between calls to
+#   `make_plots` can use, see `load_plot_data`. Set to 0 to always reload
+dataset_cache_budget = 2000
 
 ################################################################################
 ################################################################################
@@ -112,7 +152,7 @@ def list_data_files(file_path):
 
 ################################################################################
 
-def load_data(plt_dict):
+def load_data(plt_dict, workers=None, float32=False, two_tables=False, derived=None):
     """
     Find the data specified, filters, and loads them into a pandas dataframe
 
@@ -122,16 +162,330 @@ def load_data(plt_dict):
                     Examples: ('AIDJEX', 'BigBear'), ('ITP', 3, 'cormat')
     filtering_types     A list of dictionaries of the filters to apply
                     Examples: [{'p_range': [260,280]}, {'p_range': [260,280], 'interpolate': 1.0}]
+                    'interpolate' regrids every profile onto pressure levels at
+                    that spacing, see `grid_profiles`
+                    Profiles outside of a 'region' are skipped using the catalog
+                    Ex: {'region': {'center': (-145, 75), 'radius': 300}}, see `find_region_mask`
+                    or outside a 'date_range', Ex: {'date_range': ['2005/08/01', '2005/10/01']}
+    workers         Optional number of processes to read the data files with
+    float32         If True, store temp, salt, and p as 32 bit floats to save memory
+    two_tables      If True, return a table of profiles and a table of measurements
+                    linked by 'pf_key' instead of one data frame (see `split_profiles`)
+    derived         Optional list of derived_quantities to add as columns,
+                    Ex: ['sigma0', 'N2'], or True for all of them
+    """
+    # Load the data one instrument at a time, then put it all together
+    batches = list(iter_load_data(plt_dict, workers, float32, derived=derived))
+    if len(batches) > 0:
+        df = combine_profiles(batches, float32)
+        if two_tables:
+            return split_profiles(df)
+        return df
+    else:
+        print('No profiles loaded, aborting script')
+        exit(0)
+
+################################################################################
+
+def load_gridded_data(plt_dict, workers=None, float32=False):
+    """
+    Finds the data specified, filters, and regrids every profile onto the same
+    pressure levels, as set by the 'interpolate' filter, Ex: {'interpolate': 1.0}
+    Returns three things:
+    profiles        A pandas dataframe with one row per profile, with 'pf_key',
+                    the columns in profile_columns, and 'n_points', the number of
+                    measurements in the profile before regridding
+    levels          An array of the pressure levels
+    grids           A dictionary of 2D arrays of 'temp' and 'salt', with one row
+                    per profile and one column per level, and NaN for the levels
+                    outside of each profile
+
+    plt_dict        A dictionary of parameters needed to load and filter the data,
+                    see `load_data`
+    workers         Optional number of processes to read the data files with
+    float32         If True, store temp and salt as 32 bit floats to save memory
+    """
+    use_these_filters, white_list = find_filters(plt_dict)
+    if isinstance(use_these_filters, type(None)) or 'interpolate' not in use_these_filters.keys():
+        print('Gridded data needs an interpolate filter, Ex: {\'interpolate\': 1.0}')
+        exit(0)
+    spacing = use_these_filters['interpolate']
+    if use_cache:
+        # Use the cached grids if they were made from the same data files
+        store_name = find_gridded_store_name(plt_dict)
+        file_stats = find_sources_file_stats(plt_dict['data_sources'])
+        profiles, levels, chunks, cached_stats = read_gridded_store(store_name)
+        if not isinstance(profiles, type(None)) and cached_stats.equals(file_stats):
+            grids = {}
+            for var in ['temp', 'salt']:
+                grids[var] = np.concatenate([chunk[var] for chunk in chunks], axis=0)
+                if float32:
+                    grids[var] = grids[var].astype(np.float32)
+            return profiles, levels, grids
+    batches = list(iter_load_data(plt_dict, workers, float32 and not use_cache, gridded=True))
+    # Skip instruments with no levels left, where none of the pressures that
+    #   passed the filters are near a multiple of the spacing
+    batches = [batch for batch in batches if len(batch[0]) > 0 and len(batch[1]) > 0]
+    if len(batches) == 0:
+        print('No profiles loaded, aborting script')
+        exit(0)
+    # The levels of every instrument are multiples of the spacing, so put them
+    #   all on the levels that cover every instrument
+    k_starts = [int(round(levels[0]/spacing)) for profiles, levels, grids in batches]
+    k_min = min(k_starts)
+    k_max = max(k_start+len(levels)-1 for k_start, (profiles, levels, grids) in zip(k_starts, batches))
+    levels = np.round(spacing*np.arange(k_min, k_max+1), 10)
+    grids = {}
+    for var in ['temp', 'salt']:
+        grids[var] = np.full((sum(len(batch[0]) for batch in batches), len(levels)), np.nan, dtype=batches[0][2][var].dtype)
+    i_pf = 0
+    for k_start, (batch_profiles, batch_levels, batch_grids) in zip(k_starts, batches):
+        for var in grids.keys():
+            grids[var][i_pf:i_pf+len(batch_profiles), k_start-k_min:k_start-k_min+len(batch_levels)] = batch_grids[var]
+        i_pf += len(batch_profiles)
+    profiles = combine_frames([batch[0] for batch in batches])
+    profiles.insert(0, 'pf_key', np.arange(len(profiles), dtype=np.int32))
+    if use_cache:
+        write_gridded_store(store_name, profiles, levels, grids, file_stats)
+        if float32:
+            for var in grids.keys():
+                grids[var] = grids[var].astype(np.float32)
+    return profiles, levels, grids
+
+def iter_gridded_chunks(plt_dict, workers=None):
+    """
+    Goes through the cached gridded data one block of profiles at a time, so
+    that analyses of the same grids can skip parsing and regridding, and never
+    need all the grids in memory. The cache is made first if it is missing or
+    any of the data files have changed (see `load_gridded_data`)
+    Yields a pandas dataframe of the profiles in each block, the array of
+    pressure levels, and a dictionary of the memory-mapped 2D arrays of 'temp'
+    and 'salt' for those profiles
+
+    plt_dict        A dictionary of parameters needed to load and filter the data,
+                    which must have an 'interpolate' filter, see `load_data`
+    workers         Optional number of processes to read the data files with
+    """
+    if not use_cache:
+        print('Gridded data can only be read in chunks from the cache, set use_cache = True')
+        exit(0)
+    store_name = find_gridded_store_name(plt_dict)
+    profiles, levels, chunks, cached_stats = read_gridded_store(store_name)
+    if isinstance(profiles, type(None)) or not cached_stats.equals(find_sources_file_stats(plt_dict['data_sources'])):
+        # Make the cache, then let go of the grids in memory
+        load_gridded_data(plt_dict, workers)
+        profiles, levels, chunks, cached_stats = read_gridded_store(store_name)
+    for i in range(len(chunks)):
+        chunk_profiles = profiles.iloc[i*grid_chunk_size:(i+1)*grid_chunk_size]
+        yield chunk_profiles, levels, chunks[i]
+
+def find_gridded_store_name(plt_dict):
+    """
+    Names the cache of gridded data after a hash of its data sources and all of
+    its filters, including the p_range and the 'interpolate' spacing
+    Returns a string of the path to the cache, without the extension
+
+    plt_dict        A dictionary of parameters needed to load and filter the data
+    """
+    data_key = find_data_key(dict(plt_dict, plot_type=None))
+    return cache_file_path+'Gridded_'+hashlib.sha1(data_key.encode()).hexdigest()[:16]
+
+def find_sources_file_stats(data_sources):
+    """
+    Finds the stats of the data files of all the given data sources
+    Returns a pandas dataframe with one row per data file, see `find_file_stats`
+
+    data_sources        A list of tuples of the data sources
+    """
+    all_stats = []
+    for source in data_sources:
+        file_path, data_files, format, read_data_file = find_data_files(source)
+        all_stats.append(find_file_stats(file_path, data_files))
+    return pd.concat(all_stats, ignore_index=True)
+
+def write_gridded_store(store_name, profiles, levels, grids, file_stats):
+    """
+    Writes out gridded data to the cache, with the grids split into blocks of
+    grid_chunk_size profiles in separate `.npy` files so they can be read in
+    one block at a time. Any blocks left over from an older, bigger version of
+    the cache are removed
+
+    store_name          string of the path to the cache, without the extension
+    profiles            The pandas dataframe of profiles from `load_gridded_data`
+    levels              The array of pressure levels
+    grids               The dictionary of 2D arrays of 'temp' and 'salt'
+    file_stats          A pandas dataframe of the data files of all the sources,
+                        as made by `find_sources_file_stats`
+    """
+    os.makedirs(cache_file_path, exist_ok=True)
+    # Remove the file stats first and write them last, so an unfinished cache
+    #   is never used
+    if os.path.isfile(store_name+'_files.parquet'):
+        os.remove(store_name+'_files.parquet')
+    write_npy(store_name+'_levels.npy', levels)
+    n_chunks = 0
+    for i, start in enumerate(range(0, len(profiles), grid_chunk_size)):
+        for var in ['temp', 'salt']:
+            write_npy(store_name+'_'+var+'_'+str(i)+'.npy', grids[var][start:start+grid_chunk_size])
+        n_chunks = i+1
+    # Remove the blocks past the end of this version of the cache
+    store_dir, store_base = os.path.split(store_name)
+    for file in os.listdir(store_dir):
+        match = re.fullmatch(re.escape(store_base)+r'_(temp|salt)_(\d+)\.npy', file)
+        if match and int(match.group(2)) >= n_chunks:
+            os.remove(os.path.join(store_dir, file))
+    profiles.to_parquet(store_name+'_profiles.parquet')
+    file_stats.to_parquet(store_name+'_files.parquet.tmp')
+    os.replace(store_name+'_files.parquet.tmp', store_name+'_files.parquet')
+
+def read_gridded_store(store_name):
+    """
+    Opens the cached gridded data made by `write_gridded_store`. The blocks of
+    the grids are memory-mapped, so nothing is read from disk until they're used
+    Returns a pandas dataframe of the profiles, the array of levels, a list of
+    dictionaries of 'temp' and 'salt' for each block, and the data frame of
+    file stats, or four Nones if the cache is missing
+
+    store_name          string of the path to the cache, without the extension
+    """
+    if not all(os.path.isfile(store_name+end) for end in ['_profiles.parquet', '_files.parquet', '_levels.npy']):
+        return None, None, None, None
+    profiles = pd.read_parquet(store_name+'_profiles.parquet')
+    n_chunks = int(np.ceil(len(profiles)/grid_chunk_size))
+    chunks = []
+    for i in range(n_chunks):
+        paths = {var: store_name+'_'+var+'_'+str(i)+'.npy' for var in ['temp', 'salt']}
+        # The block size may have changed since the cache was written
+        if not all(os.path.isfile(path) for path in paths.values()):
+            return None, None, None, None
+        chunk = {var: np.load(path, mmap_mode='r') for var, path in paths.items()}
+        if len(chunk['temp']) != len(profiles.iloc[i*grid_chunk_size:(i+1)*grid_chunk_size]):
+            return None, None, None, None
+        chunks.append(chunk)
+    return profiles, np.load(store_name+'_levels.npy'), chunks, pd.read_parquet(store_name+'_files.parquet')
+
+################################################################################
+
+def iter_load_data(plt_dict, workers=None, float32=False, gridded=False, derived=None):
+    """
+    Finds the data specified, filters, and loads it one instrument at a time,
+    so that only one instrument's data needs to be in memory at once
+    Yields a pandas dataframe for each data source with any profiles left after
+    filtering, as made by `combine_profiles`. With an 'interpolate' filter the
+    profiles are regridded onto pressure levels first (see `grid_profiles`)
+
+    plt_dict        A dictionary of parameters needed to load and filter the data,
+                    see `load_data`
+    workers         Optional number of processes to read the data files with
+    float32         If True, store temp, salt, and p as 32 bit floats to save memory
+    gridded         If True, and there is an 'interpolate' filter, yield the
+                    profiles, levels, and grids from `grid_profiles` instead
+    derived         Optional list of derived_quantities to add as columns, or
+                    True for all of them. These are found from the whole
+                    profiles before filtering, and kept in the cache with the
+                    parsed data. With an 'interpolate' filter they are found
+                    after regridding instead
     """
     # Get list of sources
     data_sources = plt_dict['data_sources']
+    # Find the relevant filters and white_list
+    use_these_filters, white_list = find_filters(plt_dict)
+    derived = find_derived_list(derived)
+    interpolate = not isinstance(use_these_filters, type(None)) and 'interpolate' in use_these_filters.keys()
+    # Regridded data needs its derived quantities found after regridding
+    store_derived = [] if interpolate else derived
+    # Whether whole profiles are picked out with the catalog first
+    use_profile_filters = not isinstance(use_these_filters, type(None)) and any(key in profile_filters for key in use_these_filters.keys())
+    # Loop through the given sources
+    for i in range(len(data_sources)):
+        source = data_sources[i]
+        source_type = source[0]
+        instrmt = source[1]
+        print('Loading data from',source_type,instrmt)
+        # Find the data files for each profile
+        file_path, data_files, format, read_data_file = find_data_files(source)
+        # Check to see if there is a white_list for this data source
+        specific_white_list = find_specific_white_list(white_list, source_type, instrmt)
+        if use_cache:
+            # Get the table of profiles for this instrument from the cache,
+            #   along with the memory-mapped arrays of their measurements
+            profiles, arrays = load_cached_instrmt(source, file_path, data_files, instrmt, format, read_data_file, workers, store_derived)
+            # The table of profiles is the catalog, so apply the profile
+            #   filters to it directly, keeping the profiles in order
+            if use_profile_filters:
+                profiles = filter_catalog(sort_catalog(profiles), use_these_filters).sort_values(by='pf_key')
+                print('\t Loading',profiles['file_name'].nunique(),'files')
+            else:
+                print('\t Loading',len(data_files),'files')
+            # Only keep the profiles on the white_list, if there is one
+            if not isinstance(specific_white_list, type(None)):
+                profiles = profiles[profiles['prof_no'].isin(specific_white_list)]
+            # Only the measurements of the profiles selected are read from disk
+            #   then they are all filtered at once (works even if filters=None)
+            pf_dfs = [filter_data_batch(read_ragged_frame(profiles, arrays, store_derived), use_these_filters)]
+        else:
+            # Use the catalog from the headers of the data files to find which
+            #   files have profiles that pass the profile filters
+            if use_profile_filters:
+                catalog = filter_catalog(load_catalog(source, file_path, data_files, instrmt, format, read_data_file, workers), use_these_filters)
+                keep_files = set(catalog['file_name'])
+                data_files = [file for file in data_files if file in keep_files]
+            print('\t Loading',len(data_files),'files')
+            # Read in the data file for each profile. The readers only keep the
+            #   measurements in the ranges of the filters, except when derived
+            #   quantities are needed, which are found from the whole profiles,
+            #   the same as in the cache
+            if len(store_derived) > 0:
+                pf_dfs = read_data_files(file_path, data_files, instrmt, format, read_data_file, specific_white_list, None, workers)
+            else:
+                pf_dfs = read_data_files(file_path, data_files, instrmt, format, read_data_file, specific_white_list, use_these_filters, workers)
+            pf_dfs = [pf_df for pf_df in pf_dfs if not isinstance(pf_df, type(None))]
+            # Filter all the profiles at once (works even if filters=None)
+            if len(pf_dfs) > 0:
+                pf_dfs = [filter_data_batch(add_derived_quantities(combine_profiles(pf_dfs), store_derived), use_these_filters)]
+        # Create a blank list to add each profile to
+        output_list = []
+        for pf_df in pf_dfs:
+            if not isinstance(pf_df, type(None)):
+                # Remove rows of the data frame with missing data
+                #   Note: only apply to temp, salt, and p because 'format' will often be
+                #       set to a null value, for exmaple with AIDJEX data
+                pf_df = pf_df[pf_df.temp.notnull() & pf_df.salt.notnull() & pf_df.p.notnull()]
+                # Skip any profiles that were filtered out completely
+                if len(pf_df) > 0:
+                    output_list.append(pf_df)
+        # Concatenate all the profiles from this instrument into a dataframe
+        if len(output_list) > 0:
+            df = combine_profiles(output_list, float32)
+            if not interpolate:
+                yield df
+                continue
+            # Regrid every profile onto the same pressure levels
+            profiles, levels, grids = grid_profiles(df, use_these_filters['interpolate'])
+            if gridded:
+                yield profiles, levels, grids
+                continue
+            df = gridded_to_frame(profiles, levels, grids)
+            if len(df) > 0:
+                yield add_derived_quantities(df, derived)
+
+################################################################################
+
+def find_filters(plt_dict):
+    """
+    Finds the dictionary of filters to apply and the white_list, if any
+    Returns the dictionary of filters (or None) and the white_list (or None)
+
+    plt_dict        A dictionary of parameters needed to load and filter the data
+    """
     # Get list of filters
     filters = plt_dict['filtering_types']
     # Find the relevant filters
     if len(filters) == 1:
         use_these_filters = filters[0]
     elif len(filters) > 1:
-        use_these_filters = filters[i]
+        print('Only one dictionary of filters can be used for each subplot')
+        exit(0)
     else:
         use_these_filters = None
     # Check to see if there is a white_list
@@ -142,61 +496,986 @@ def load_data(plt_dict):
         white_list = use_these_filters['white_list']
     else:
         white_list = None
-    # Create a blank list to add each profile to
-    output_list = []
-    # Loop through the given sources
-    for i in range(len(data_sources)):
-        source = data_sources[i]
-        source_type = source[0]
-        instrmt = source[1]
-        print('Loading data from',source_type,instrmt)
-        # Set parameters based on the type of data to load
-        if source_type == 'AIDJEX':
-            format = ''
-            file_path = science_data_file_path+'AIDJEX/AIDJEX/'+instrmt
-            read_data_file = read_AIDJEX_data_file
-        elif source_type == 'ITP':
-            format = source[2]
-            file_path = science_data_file_path+'ITPs/itp'+str(instrmt)+'/itp'+str(instrmt)+format
-            read_data_file = read_ITP_data_file
-        # Loop through the data files for each profile
-        data_files = list_data_files(file_path)
-        if isinstance(data_files, type(None)):
-            print('Did not find any files')
-            exit(0)
+    return use_these_filters, white_list
+
+################################################################################
+
+def find_data_files(source):
+    """
+    Finds where the data files of a source are and how to read them
+    Returns the path to the containing directory, the list of data files, the
+    format of the files, and the function to read each file with
+
+    source          A tuple of the data to find
+                    Examples: ('AIDJEX', 'BigBear'), ('ITP', '3', 'cormat')
+    """
+    source_type = source[0]
+    instrmt = source[1]
+    # Set parameters based on the type of data to load
+    if source_type == 'AIDJEX':
+        format = ''
+        file_path = science_data_file_path+'AIDJEX/AIDJEX/'+instrmt
+        read_data_file = read_AIDJEX_data_file
+    elif source_type == 'ITP':
+        format = source[2]
+        file_path = science_data_file_path+'ITPs/itp'+str(instrmt)+'/itp'+str(instrmt)+format
+        read_data_file = read_ITP_data_file
+    # List the data files for each profile
+    data_files = list_data_files(file_path)
+    if isinstance(data_files, type(None)):
+        print('Did not find any files')
+        exit(0)
+    return file_path, data_files, format, read_data_file
+
+################################################################################
+
+def find_specific_white_list(white_list, source_type, instrmt):
+    """
+    Finds the part of the white_list for one instrument
+    Returns a list of profile numbers, or None if there is no white_list for
+    that instrument
+
+    white_list          A dictionary of dictionaries, like {source: {instrmt: [x,y,z]}}
+    source_type         string of the type of source, Ex: 'ITP'
+    instrmt             string of the instrument
+    """
+    if not isinstance(white_list, type(None)):
+        # Check source
+        if source_type in white_list.keys():
+            specific_white_list = white_list[source_type]
+            if instrmt in specific_white_list.keys():
+                return specific_white_list[instrmt]
+    return None
+
+################################################################################
+
+def make_profile_df(source, instrmt, prof_no, lon, lat, date, format, notes, temp, salt, p):
+    """
+    Builds the data frame for one profile. The text values are the same for
+    every measurement in a profile, so they are stored as categoricals, which
+    keep one small integer code per row instead of a Python object per row
+    Returns a pandas dataframe
+
+    source              string of the source of the data, Ex: 'ITP'
+    instrmt             string of the instrument that took the profile
+    prof_no             The number identifying this specific profile
+    lon, lat            The longitude and latitude of the profile, or None
+    date                The date the profile was taken, or None
+    format              The format of the datafile where the data came from
+    notes               A string of notes on the profile
+    temp                An array of temperature values
+    salt                An array of salinity values
+    p                   An array of depth values (in m or dbar)
+    """
+    n_pts = len(temp)
+    codes = np.zeros(n_pts, dtype=np.int8)
+    # Missing locations and dates become NaN and NaT
+    if isinstance(lon, type(None)):
+        lon = np.nan
+    if isinstance(lat, type(None)):
+        lat = np.nan
+    return pd.DataFrame({'source': pd.Categorical.from_codes(codes, [source]),
+                         'instrmt': pd.Categorical.from_codes(codes, [instrmt]),
+                         'prof_no': pd.Categorical.from_codes(codes, [str(prof_no)]),
+                         'lon': np.full(n_pts, lon, dtype=float),
+                         'lat': np.full(n_pts, lat, dtype=float),
+                         'date': np.full(n_pts, pd.Timestamp(date).to_datetime64()).astype('datetime64[ns]'),
+                         'format': pd.Categorical.from_codes(codes, [format]),
+                         'notes': pd.Categorical.from_codes(codes, [notes]),
+                         'temp': temp,
+                         'salt': salt,
+                         'p': p
+                        })
+
+################################################################################
+
+def combine_profiles(pf_dfs, float32=False):
+    """
+    Concatenates a list of data frames of profiles into one compact data frame.
+    Text columns are combined as categoricals, so no column of Python objects
+    is ever made, and a 'pf_key' column gives each profile an integer key
+    Returns a pandas dataframe
+
+    pf_dfs              A list of pandas dataframes with the same columns
+    float32             If True, store temp, salt, and p as 32 bit floats
+    """
+    df = combine_frames(pf_dfs)
+    if float32:
+        for col in ['temp', 'salt', 'p']:
+            df[col] = df[col].astype(np.float32)
+    return add_pf_key(df)
+
+def combine_frames(dfs):
+    """
+    Concatenates a list of data frames, combining any text columns as
+    categoricals. Any 'pf_key' column is dropped, as the keys of different
+    data frames would clash
+    Returns a pandas dataframe
+
+    dfs                 A list of pandas dataframes with the same columns
+    """
+    out_dict = {}
+    for col in dfs[0].columns:
+        if col == 'pf_key':
             continue
-        #
-        # Check to see if there is a white_list for this data source
-        if not isinstance(white_list, type(None)):
-            # Check source
-            if source_type in white_list.keys():
-                specific_white_list = white_list[source_type]
-                if instrmt in specific_white_list.keys():
-                    specific_white_list = specific_white_list[instrmt]
-                else:
-                    specific_white_list = None
-            else:
-                specific_white_list = None
+        if dfs[0][col].dtype == object or isinstance(dfs[0][col].dtype, pd.CategoricalDtype):
+            # Merge the categories of all the data frames together
+            out_dict[col] = union_categoricals([df[col].astype('category') for df in dfs], sort_categories=True)
         else:
-            specific_white_list = None
-        print('\t Loading',len(data_files),'files')
-        for file in data_files:
+            out_dict[col] = np.concatenate([df[col].values for df in dfs])
+    return pd.DataFrame(out_dict)
+
+def add_pf_key(df):
+    """
+    Adds a 'pf_key' column to a data frame of profiles, numbering each profile
+    in the order they first appear
+    Returns the pandas dataframe
+
+    df                  A pandas dataframe of profiles
+    """
+    df['pf_key'] = df.groupby(['source', 'instrmt', 'format', 'prof_no'], sort=False, observed=True).ngroup().astype(np.int32)
+    return df
+
+################################################################################
+
+# The columns which have the same value for every measurement in a profile
+profile_columns = ['source', 'instrmt', 'prof_no', 'lon', 'lat', 'date', 'format', 'notes']
+
+def split_profiles(data):
+    """
+    Splits a data frame made by `combine_profiles` into two linked tables so
+    that anything which only needs the metadata of each profile can work with
+    one row per profile instead of one row per measurement. This is also how
+    the one row per profile tables for plots are made
+    Returns two pandas dataframes:
+    profiles        One row per profile, with 'pf_key', the columns in
+                    profile_columns, and 'n_points', the number of measurements
+    measurements    One row per measurement, with 'pf_key' and all the other
+                    columns (temp, salt, p, ...)
+
+    data                A pandas dataframe with a 'pf_key' column, and
+                        'n_points' if it is a catalog with one row per profile
+    """
+    # Every row of a profile has the same metadata, so take the first row of each
+    first_rows = ~data['pf_key'].duplicated()
+    profiles = data.loc[first_rows, ['pf_key']+profile_columns].sort_values(by='pf_key')
+    profiles = profiles.reset_index(drop=True)
+    # A catalog already counts the measurements in each profile
+    if 'n_points' in data.columns:
+        weights = np.asarray(data['n_points'], dtype=np.int64)
+    else:
+        weights = None
+    counts = np.bincount(data['pf_key'], weights=weights, minlength=len(profiles))
+    profiles['n_points'] = counts.astype(np.int64)[profiles['pf_key']]
+    measurements = data[[col for col in data.columns if col not in profile_columns]]
+    return profiles, measurements
+
+################################################################################
+
+# The quantities that can be derived from temp, salt, and p, see `find_derived_arrays`
+#   SA: Absolute Salinity (g/kg), CT: Conservative Temperature (C),
+#   sigma0: potential density anomaly referenced to 0 dbar (kg/m^3),
+#   spiciness0: spiciness referenced to 0 dbar (kg/m^3),
+#   N2: squared buoyancy frequency (1/s^2)
+derived_quantities = ['SA', 'CT', 'sigma0', 'spiciness0', 'N2']
+
+def find_derived_list(derived):
+    """
+    Returns the list of derived quantities asked for, or an empty list
+
+    derived         True for all of the derived_quantities, or a list of some of them
+    """
+    if isinstance(derived, type(None)) or derived is False:
+        return []
+    if derived is True:
+        return list(derived_quantities)
+    for quantity in derived:
+        if quantity not in derived_quantities:
+            print('Derived quantity',quantity,'not recognized, aborting script')
+            exit(0)
+    return list(derived)
+
+def add_derived_quantities(data, derived=True):
+    """
+    Adds columns of quantities derived from temp, salt, and p, calculated for
+    every measurement in the data frame at once (see `find_derived_arrays`)
+    Returns the pandas dataframe with the new columns
+
+    data            A pandas dataframe of profiles, as made by `combine_profiles`
+    derived         True for all of the derived_quantities, or a list of some of them
+    """
+    derived = find_derived_list(derived)
+    if len(derived) == 0:
+        return data
+    arrays = find_derived_arrays(derived, np.asarray(data['source']), np.asarray(data['lon'], dtype=float), np.asarray(data['lat'], dtype=float), np.asarray(data['temp'], dtype=float), np.asarray(data['salt'], dtype=float), np.asarray(data['p'], dtype=float), np.asarray(data['pf_key']))
+    data = data.copy()
+    for quantity in derived:
+        data[quantity] = arrays[quantity]
+    return data
+
+def find_derived_arrays(derived, source, lon, lat, temp, salt, p, pf_key):
+    """
+    Calculates quantities derived from temp, salt, and p using TEOS-10, for
+    any number of profiles at once. N2 is found between each pair of adjacent
+    measurements of a profile after sorting by pressure, then the two values
+    either side of each measurement are averaged
+    Returns a dictionary of arrays with one value per measurement
+
+    derived         A list of some of the derived_quantities
+    source          An array of the data source of each measurement
+    lon             An array of the longitude of each measurement
+    lat             An array of the latitude of each measurement
+    temp            An array of the in-situ temperatures (C)
+    salt            An array of the practical salinities
+    p               An array of the pressures (dbar), or depths (m) for AIDJEX
+    pf_key          An array of which profile each measurement belongs to
+    """
+    # AIDJEX data gives depth in meters instead of pressure
+    p = p.copy()
+    is_depth = (source == 'AIDJEX') & ~np.isnan(lat)
+    p[is_depth] = gsw.p_from_z(-p[is_depth], lat[is_depth])
+    # Use Reference Salinity where there is no position to find Absolute Salinity
+    SA = gsw.SR_from_SP(salt)
+    has_pos = ~np.isnan(lon) & ~np.isnan(lat)
+    SA[has_pos] = gsw.SA_from_SP(salt[has_pos], p[has_pos], lon[has_pos], lat[has_pos])
+    CT = gsw.CT_from_t(SA, temp, p)
+    out_dict = {'SA': SA, 'CT': CT}
+    if 'sigma0' in derived:
+        out_dict['sigma0'] = gsw.sigma0(SA, CT)
+    if 'spiciness0' in derived:
+        out_dict['spiciness0'] = gsw.spiciness0(SA, CT)
+    if 'N2' in derived:
+        N2 = np.full(len(p), np.nan)
+        if len(p) > 1:
+            # Put the measurements of each profile together, in order of pressure,
+            #   then find N2 between every pair of neighbors in one call
+            order = np.lexsort((p, pf_key))
+            mid_N2 = gsw.Nsquared(SA[order], CT[order], p[order], lat[order])[0]
+            # Neighbors from different profiles, or at the same pressure, don't count
+            p_sorted = p[order]
+            mid_N2[(pf_key[order][1:] != pf_key[order][:-1]) | (p_sorted[1:] == p_sorted[:-1])] = np.nan
+            above = np.concatenate([[np.nan], mid_N2])
+            below = np.concatenate([mid_N2, [np.nan]])
+            n_valid = np.isfinite(above).astype(int) + np.isfinite(below)
+            total = np.where(np.isfinite(above), above, 0) + np.where(np.isfinite(below), below, 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                N2[order] = np.where(n_valid > 0, total/n_valid, np.nan)
+        out_dict['N2'] = N2
+    return {quantity: out_dict[quantity] for quantity in derived}
+
+################################################################################
+
+def read_data_files(file_path, data_files, instrmt, format, read_data_file, white_list=None, filters=None, workers=None, metadata_only=False):
+    """
+    Reads in and filters each of the data files, either one at a time or split
+    into chunks across a pool of processes
+    Returns a list with a pandas dataframe (or None) for each data file, in the
+    same order as data_files
+
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    instrmt             string of the instrument that took the data in the files
+    format              The format of the data files
+    read_data_file      The function to use to read in each data file
+    white_list          Optional list of profile numbers to actually load
+    filters             A dictionary of filters, of which the readers apply
+                        only the ranges, leaving the rest to `filter_data_batch`
+    workers             Optional number of processes to read the data files with
+    metadata_only       If True, return the catalog entry of each profile instead
+    """
+    if isinstance(workers, type(None)) or workers < 2 or len(data_files) < 2:
+        results = [read_data_files_chunk((file_path, data_files, instrmt, format, read_data_file, white_list, filters, metadata_only))]
+    else:
+        # Use several chunks per process so they all stay busy until the end
+        n_chunks = min(len(data_files), 4*workers)
+        chunks = np.array_split(np.array(data_files), n_chunks)
+        args = [(file_path, chunk, instrmt, format, read_data_file, white_list, filters, metadata_only) for chunk in chunks]
+        # `map` returns the chunks in order, so the profiles stay in order too
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(read_data_files_chunk, args))
+    if prefetch_depth > 0 and isinstance(white_list, type(None)) and not metadata_only:
+        # Report how long the parser sat waiting on files to be read
+        io_wait = sum(result[1] for result in results)
+        parse_time = sum(result[2] for result in results)
+        print('\t Waited','%.2f'%io_wait,'s on reading files,','%.2f'%parse_time,'s parsing')
+    return [pf_df for result in results for pf_df in result[0]]
+
+def read_data_files_chunk(args):
+    """
+    Reads in and filters one chunk of data files. This is what each process in
+    the pool runs, so it takes a single tuple of arguments. If prefetch_depth
+    is set, the files are read ahead of the parser by `prefetch_data_files`,
+    unless there is a white_list, which lets most files be skipped without
+    opening them, or only the metadata is needed, which is just part of each file
+    Returns a list with a pandas dataframe (or None) for each data file, the
+    time in seconds spent waiting on files to be read, and the time spent
+    parsing them
+
+    args                A tuple of the arguments to `read_data_files`, where
+                        data_files is just the files in this chunk
+    """
+    file_path, data_files, instrmt, format, read_data_file, white_list, filters, metadata_only = args
+    if prefetch_depth > 0 and isinstance(white_list, type(None)) and not metadata_only:
+        files = prefetch_data_files(file_path, data_files, prefetch_depth)
+    else:
+        files = ((file, None) for file in data_files)
+    pf_dfs = []
+    io_wait = 0
+    parse_time = 0
+    while True:
+        # Wait for the next file to be read
+        start_time = time.perf_counter()
+        try:
+            file, file_bytes = next(files)
+        except StopIteration:
+            break
+        read_time = time.perf_counter()
+        io_wait += read_time - start_time
+        if not isinstance(file_bytes, type(None)):
+            prefetched_files[file_path+'/'+file] = file_bytes
+        try:
             # Read in the data file for this profile
-            pf_df = read_data_file(file_path, file, instrmt, format, specific_white_list)
-            if not isinstance(pf_df, type(None)):
-                # Apply filters (works even if filters=None)
-                pf_df = filter_data(pf_df, use_these_filters)
-            if not isinstance(pf_df, type(None)):
-                # Remove rows of the data frame with missing data
-                #   Note: only apply to temp, salt, and p because 'format' will often be
-                #       set to a null value, for exmaple with AIDJEX data
-                pf_df = pf_df[pf_df.temp.notnull() & pf_df.salt.notnull() & pf_df.p.notnull()]
-                output_list.append(pf_df)
-    # Concatenate all the profiles in the list into a dataframe
-    # exit(0)
+            pf_df = read_data_file(file_path, file, instrmt, format, white_list, filters, metadata_only)
+        finally:
+            prefetched_files.pop(file_path+'/'+file, None)
+        parse_time += time.perf_counter() - read_time
+        pf_dfs.append(pf_df)
+    return pf_dfs, io_wait, parse_time
+
+################################################################################
+
+# The bytes of the data files that have been read ahead, by path
+prefetched_files = {}
+
+def prefetch_data_files(file_path, data_files, depth):
+    """
+    Reads data files on a pool of threads, staying up to `depth` files ahead of
+    the file being parsed. Reading a file mostly waits on the disk or network,
+    so the threads can run while the parser is busy with the previous files
+    Yields the name and the bytes of each data file, in order
+
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    depth               The number of files to have read ahead at a time
+    """
+    files = iter(data_files)
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        reads = deque()
+        # Start reading the first files
+        for file in files:
+            reads.append((file, pool.submit(read_file_bytes, file_path+'/'+file)))
+            if len(reads) == depth:
+                break
+        while len(reads) > 0:
+            file, read = reads.popleft()
+            # Start reading another file to replace this one
+            for next_file in files:
+                reads.append((next_file, pool.submit(read_file_bytes, file_path+'/'+next_file)))
+                break
+            yield file, read.result()
+
+def read_file_bytes(path):
+    """
+    Reads the whole of a file
+    Returns the bytes of the file
+
+    path                string of the path to the file
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def open_data_file(file_path, file_name, mode='r'):
+    """
+    Opens a data file, using the bytes read ahead by `prefetch_data_files` if
+    there are any instead of opening the file again
+    Returns a file object
+
+    file_path           string of a file path to the containing directory
+    file_name           string of the file name of a specific file
+    mode                Either 'r' to read text or 'rb' to read bytes
+    """
+    file_bytes = prefetched_files.get(file_path+'/'+file_name)
+    if isinstance(file_bytes, type(None)):
+        return open(file_path+'/'+file_name, mode)
+    if mode == 'rb':
+        return BytesIO(file_bytes)
+    # Decode the text the same way `open` would
+    return TextIOWrapper(BytesIO(file_bytes))
+
+################################################################################
+
+def find_file_stats(file_path, data_files):
+    """
+    Finds the path, size, and modification time of each data file so the cache
+    can tell whether any of the files have changed since they were parsed
+    Returns a pandas dataframe with one row per data file
+
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    """
+    paths  = [file_path+'/'+file for file in data_files]
+    stats  = [os.stat(path) for path in paths]
+    return pd.DataFrame({'file_name': list(data_files),
+                         'path': paths,
+                         'size': [stat.st_size for stat in stats],
+                         'mtime': [stat.st_mtime for stat in stats]
+                        })
+
+################################################################################
+
+def load_cached_instrmt(source, file_path, data_files, instrmt, format, read_data_file, workers=None, derived=None):
+    """
+    Opens the cache of parsed data for one instrument, which is a ragged array
+    store (see `write_ragged_store`). If the cache is missing, or any of the
+    data files have been added, changed, or deleted, the cache is brought up to
+    date first (see `update_cache`)
+    Returns a pandas dataframe of the profiles, with one row per profile, and a
+    dictionary of the memory-mapped arrays of their measurements
+
+    source              A tuple of the data source, Ex: ('ITP', '2', 'cormat')
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    instrmt             string of the instrument that took the data in the files
+    format              The format of the data files
+    read_data_file      The function to use to read in each data file
+    workers             Optional number of processes to read the data files with
+    derived             Optional list of derived_quantities to include, which are
+                        calculated and added to the store if they aren't there yet
+    """
+    # One cache file per instrument, plus the stats of the files it came from
+    cache_name = cache_file_path+'_'.join(str(item) for item in source)
+    file_stats = find_file_stats(file_path, data_files)
+    profiles, arrays, cached_stats = read_ragged_store(cache_name)
+    if isinstance(profiles, type(None)) or not cached_stats.equals(file_stats):
+        update_cache(cache_name, file_path, data_files, instrmt, format, read_data_file, workers)
+        profiles, arrays, cached_stats = read_ragged_store(cache_name)
+    missing = [quantity for quantity in find_derived_list(derived) if quantity not in arrays.keys()]
+    if len(missing) > 0:
+        arrays.update(write_derived_arrays(cache_name, profiles, arrays, missing))
+    return profiles, arrays
+
+################################################################################
+
+def update_cache(cache_name, file_path, data_files, instrmt, format, read_data_file, workers=None):
+    """
+    Loads a cached data frame and brings it up to date with the data files.
+    Only the files that are new or have changed since the cache was written
+    are parsed, and the rows from any files that have been deleted are dropped,
+    so re-syncing a directory that gained a few profiles is quick
+    Returns a pandas dataframe with a 'file_name' column, with the rows in the
+    same order as data_files
+
+    cache_name          string of the path to the cache, without the extension
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    instrmt             string of the instrument that took the data in the files
+    format              The format of the data files
+    read_data_file      The function to use to read in each data file
+    workers             Optional number of processes to read the data files with
+    """
+    file_stats = find_file_stats(file_path, data_files)
+    cached_df, cached_stats = read_ragged_store_frame(cache_name)
+    if isinstance(cached_df, type(None)):
+        print('\t Caching',len(data_files),'files')
+        dfs = []
+        new_files = list(data_files)
+    else:
+        if cached_stats.equals(file_stats):
+            return cached_df
+        # Find which files are new or have a different path, size, or
+        #   modification time than when they were cached
+        merged = file_stats.merge(cached_stats, on='file_name', how='left', suffixes=('', '_cached'))
+        unchanged = (merged['path'] == merged['path_cached']) & (merged['size'] == merged['size_cached']) & (merged['mtime'] == merged['mtime_cached'])
+        new_files = list(merged.loc[~unchanged, 'file_name'])
+        n_deleted = (~cached_stats['file_name'].isin(file_stats['file_name'])).sum()
+        print('\t Updating cache:',len(new_files),'new or changed files,',n_deleted,'deleted files')
+        # Keep the cached rows of the files that are still there and unchanged
+        dfs = [cached_df[cached_df['file_name'].isin(merged.loc[unchanged, 'file_name'])]]
+    new_df = read_files_to_frame(file_path, new_files, instrmt, format, read_data_file, workers)
+    if not isinstance(new_df, type(None)):
+        dfs.append(new_df)
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) > 0:
+        df = combine_frames(dfs)
+        # Put the rows back in the order of the data files, keeping the order
+        #   of the rows from each file
+        file_order = pd.Categorical(df['file_name'], categories=file_stats['file_name']).codes
+        df = df.iloc[np.argsort(file_order, kind='stable')].reset_index(drop=True)
+        df = add_pf_key(df)
+    else:
+        df = pd.DataFrame(columns=profile_columns+['temp', 'salt', 'p', 'file_name'])
+    # Write out the cache for next time
+    write_ragged_store(cache_name, df, file_stats)
+    return df
+
+def read_files_to_frame(file_path, data_files, instrmt, format, read_data_file, workers=None, metadata_only=False):
+    """
+    Parses every profile in a list of data files, without a white_list or any
+    filters, into one data frame
+    Returns a pandas dataframe with a 'file_name' column, or None if none of
+    the files had a profile
+
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names to parse
+    instrmt             string of the instrument that took the data in the files
+    format              The format of the data files
+    read_data_file      The function to use to read in each data file
+    workers             Optional number of processes to read the data files with
+    metadata_only       If True, make the catalog rows instead of the data
+    """
+    if len(data_files) == 0:
+        return None
+    outputs = read_data_files(file_path, data_files, instrmt, format, read_data_file, workers=workers, metadata_only=metadata_only)
+    if metadata_only:
+        rows = [dict(row, file_name=file) for file, row in zip(data_files, outputs) if not isinstance(row, type(None))]
+        if len(rows) == 0:
+            return None
+        catalog = pd.DataFrame(rows, columns=catalog_columns)
+        for col in ['source', 'instrmt', 'prof_no', 'format', 'notes', 'file_name']:
+            catalog[col] = catalog[col].astype('category')
+        return catalog
+    pf_dfs = []
+    for file, pf_df in zip(data_files, outputs):
+        if not isinstance(pf_df, type(None)):
+            pf_df['file_name'] = file
+            pf_dfs.append(pf_df)
+    if len(pf_dfs) == 0:
+        return None
+    return combine_frames(pf_dfs)
+
+################################################################################
+
+# The columns of measurements kept in the flat arrays of a ragged array store
+ragged_columns = ['temp', 'salt', 'p']
+
+def write_ragged_store(store_name, df, file_stats):
+    """
+    Writes out a data frame of profiles as a ragged array store: one flat `.npy`
+    file for each of temp, salt, and p with all the profiles end to end, an
+    array of offsets where profile i is the rows offsets[i] to offsets[i+1],
+    and a table with one row per profile of its metadata and 'n_complete', the
+    number of its measurements with all of temp, salt, and p. Each file is written
+    under a temporary name and then swapped in, so any arrays already mapped
+    from an older version of the store stay valid. The table of file stats is
+    removed first and written last, so if writing is interrupted the store
+    counts as missing instead of mixing old and new files. Any derived arrays
+    from an older version are removed, to be calculated again when needed
+    (see `write_derived_arrays`)
+
+    store_name          string of the path to the store, without the extension
+    df                  A pandas dataframe of profiles with a 'file_name' column,
+                        as made by `combine_profiles`
+    file_stats          A pandas dataframe of the data files, as made by
+                        `find_file_stats`
+    """
+    os.makedirs(cache_file_path, exist_ok=True)
+    if os.path.isfile(store_name+'_files.parquet'):
+        os.remove(store_name+'_files.parquet')
+    if len(df) > 0:
+        # Make sure the rows of each profile are together and in key order
+        df = df.sort_values(by='pf_key', kind='mergesort')
+        profiles, measurements = split_profiles(df)
+        profiles['file_name'] = df.loc[~df['pf_key'].duplicated(), 'file_name'].values
+        arrays = {col: np.asarray(measurements[col].values, dtype=float) for col in ragged_columns}
+        # Count the measurements `load_data` would keep, for the catalog
+        complete = np.isfinite(arrays['temp']) & np.isfinite(arrays['salt']) & np.isfinite(arrays['p'])
+        pf_rows = np.repeat(np.arange(len(profiles)), np.asarray(profiles['n_points'], dtype=np.int64))
+        profiles['n_complete'] = np.bincount(pf_rows, weights=complete, minlength=len(profiles)).astype(np.int64)
+    else:
+        profiles = pd.DataFrame(columns=['pf_key']+profile_columns+['n_points', 'file_name', 'n_complete'])
+        arrays = {col: np.zeros(0) for col in ragged_columns}
+    arrays['offsets'] = np.concatenate([[0], np.cumsum(np.asarray(profiles['n_points'], dtype=np.int64))])
+    # Write the offsets after the arrays they index into
+    for key in ragged_columns+['offsets']:
+        write_npy(store_name+'_'+key+'.npy', arrays[key])
+    for quantity in derived_quantities:
+        if os.path.isfile(store_name+'_'+quantity+'.npy'):
+            os.remove(store_name+'_'+quantity+'.npy')
+    profiles.to_parquet(store_name+'_profiles.parquet.tmp')
+    os.replace(store_name+'_profiles.parquet.tmp', store_name+'_profiles.parquet')
+    file_stats.to_parquet(store_name+'_files.parquet.tmp')
+    os.replace(store_name+'_files.parquet.tmp', store_name+'_files.parquet')
+
+def write_npy(path, array):
+    """
+    Writes out an array to a `.npy` file under a temporary name first, so that
+    any array already mapped from an older version of the file stays valid
+
+    path                string of the path to the file
+    array               The numpy array to write
+    """
+    with open(path+'.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path+'.tmp', path)
+
+def write_derived_arrays(store_name, profiles, arrays, derived):
+    """
+    Calculates derived quantities for every measurement in a ragged array store
+    at once, and writes them out next to the temp, salt, and p arrays
+    Returns a dictionary of the memory-mapped derived arrays
+
+    store_name          string of the path to the store, without the extension
+    profiles            A pandas dataframe of the profile table from `read_ragged_store`
+    arrays              The dictionary of arrays from `read_ragged_store`
+    derived             A list of some of the derived_quantities
+    """
+    n_points = np.diff(np.asarray(arrays['offsets'], dtype=np.int64))
+    pf_key = np.repeat(np.arange(len(n_points)), n_points)
+    # The profile table is in key order, so spread its values over the measurements
+    source = np.asarray(profiles['source'].astype(str)).take(pf_key)
+    lon = np.asarray(profiles['lon'], dtype=float).take(pf_key)
+    lat = np.asarray(profiles['lat'], dtype=float).take(pf_key)
+    values = find_derived_arrays(derived, source, lon, lat, np.asarray(arrays['temp']), np.asarray(arrays['salt']), np.asarray(arrays['p']), pf_key)
+    out_dict = {}
+    for quantity in derived:
+        write_npy(store_name+'_'+quantity+'.npy', values[quantity])
+        out_dict[quantity] = np.load(store_name+'_'+quantity+'.npy', mmap_mode='r')
+    return out_dict
+
+def read_ragged_store(store_name):
+    """
+    Opens a ragged array store made by `write_ragged_store`. The arrays are
+    memory-mapped, so nothing is read from disk until it is sliced, and then
+    only the slices are copied into memory
+    Returns a pandas dataframe of the profiles, a dictionary of the arrays,
+    and the data frame of file stats, or three Nones if the store is missing
+    or its files don't match. Any derived arrays made by `write_derived_arrays`
+    are included
+
+    store_name          string of the path to the store, without the extension
+    """
+    paths = [store_name+'_'+key+'.npy' for key in ragged_columns+['offsets']]
+    paths += [store_name+'_profiles.parquet', store_name+'_files.parquet']
+    if not all(os.path.isfile(path) for path in paths):
+        return None, None, None
+    arrays = {key: np.load(store_name+'_'+key+'.npy', mmap_mode='r') for key in ragged_columns+['offsets']}
+    for quantity in derived_quantities:
+        if os.path.isfile(store_name+'_'+quantity+'.npy'):
+            arrays[quantity] = np.load(store_name+'_'+quantity+'.npy', mmap_mode='r')
+    profiles = pd.read_parquet(store_name+'_profiles.parquet')
+    # Check that the offsets fit the profiles and the arrays, and that the
+    #   store isn't from before the complete measurements were counted
+    offsets = arrays['offsets']
+    if 'n_complete' not in profiles.columns or len(offsets) != len(profiles)+1 or any(len(array) != offsets[-1] for key, array in arrays.items() if key != 'offsets'):
+        return None, None, None
+    return profiles, arrays, pd.read_parquet(store_name+'_files.parquet')
+
+def read_ragged_store_frame(store_name):
+    """
+    Reads all of a ragged array store into memory as one data frame, with the
+    same columns as when it was written. Every measurement is copied out of
+    the memory-mapped arrays, so this is only used to update the store
+    Returns a pandas dataframe and the data frame of file stats, or two Nones
+    if the store is missing
+
+    store_name          string of the path to the store, without the extension
+    """
+    profiles, arrays, file_stats = read_ragged_store(store_name)
+    if isinstance(profiles, type(None)):
+        return None, None
+    # Repeat the metadata of each profile for each of its measurements
+    df = profiles.loc[profiles.index.repeat(profiles['n_points'])].drop(['n_points', 'n_complete'], axis=1)
+    df = df.reset_index(drop=True)
+    for col in ragged_columns:
+        df[col] = np.array(arrays[col])
+    return df, file_stats
+
+def read_ragged_frame(profiles, arrays, derived=None):
+    """
+    Makes one data frame of the given profiles out of a ragged array store.
+    Only the measurements of the profiles asked for are ever read from disk,
+    and they are copied into the new data frame
+    Returns a pandas dataframe, with a 'pf_key' column numbering the profiles
+    in the order they were given
+
+    profiles            A pandas dataframe of some of the rows of the profile
+                        table from `read_ragged_store`
+    arrays              The dictionary of arrays from `read_ragged_store`
+    derived             Optional list of derived_quantities in arrays to include
+    """
+    starts = np.asarray(arrays['offsets'][profiles['pf_key']], dtype=np.int64)
+    n_points = np.asarray(profiles['n_points'], dtype=np.int64)
+    # Find the row of each measurement in the flat arrays, and which of the
+    #   given profiles it belongs to
+    rows = np.repeat(np.arange(len(profiles)), n_points)
+    pf_starts = np.concatenate([[0], np.cumsum(n_points)[:-1]]).astype(np.int64)
+    index = np.arange(len(rows)) + np.repeat(starts - pf_starts, n_points)
+    out_dict = {}
+    for col in profile_columns:
+        out_dict[col] = profiles[col].values.take(rows)
+    for col in ragged_columns+find_derived_list(derived):
+        out_dict[col] = arrays[col][index]
+    df = pd.DataFrame(out_dict)
+    df['pf_key'] = rows.astype(np.int32)
+    return df
+
+################################################################################
+
+# The columns of the catalog, which has one row per profile
+catalog_columns = profile_columns+['file_name']
+# The plot types which only need the metadata of each profile. These use the
+#   catalog from the cached data, as that knows which profiles `load_data` keeps
+catalog_plot_types = ['map', 'date_hist']
+# The filters that can be applied to the catalog. Filters on the measurements,
+#   like 'p_range', need `load_data` to find which profiles have any left
+catalog_filters = ['white_list', 'region', 'date_range']
+# The filters that pick out whole profiles using the catalog, so that the data
+#   files of any other profiles never need to be opened
+profile_filters = ['region', 'date_range']
+
+def use_catalog(plt_dict):
+    """
+    Checks whether a subplot only needs the metadata of each profile and uses
+    only filters that can be applied to the catalog. Without the cache, the
+    catalog doesn't know which profiles have any complete measurements, so
+    these subplots load the data instead
+    Returns True or False
+
+    plt_dict        A dictionary containing the info to create this subplot
+    """
+    if not use_cache or plt_dict['plot_type'] not in catalog_plot_types:
+        return False
+    use_these_filters, white_list = find_filters(plt_dict)
+    if isinstance(use_these_filters, type(None)):
+        return True
+    return all(key in catalog_filters for key in use_these_filters.keys())
+
+################################################################################
+
+def make_catalog_row(source, instrmt, prof_no, lon, lat, date, format, notes):
+    """
+    Makes the catalog entry of one profile from the header of its data file,
+    without any of its measurements
+    Returns a dictionary
+
+    source              string of the source of the data, Ex: 'ITP'
+    instrmt             string of the instrument that took the profile
+    prof_no             The number identifying this specific profile
+    lon, lat            The longitude and latitude of the profile, or None
+    date                The date the profile was taken, or None
+    format              The format of the datafile where the data came from
+    notes               A string of notes on the profile
+    """
+    return {'source': source,
+            'instrmt': instrmt,
+            'prof_no': str(prof_no),
+            'lon': np.nan if isinstance(lon, type(None)) else lon,
+            'lat': np.nan if isinstance(lat, type(None)) else lat,
+            'date': pd.Timestamp(date),
+            'format': format,
+            'notes': notes
+           }
+
+################################################################################
+
+def load_catalog(source, file_path, data_files, instrmt, format, read_data_file, workers=None):
+    """
+    Loads the catalog of one instrument, which has one row per profile with its
+    metadata and the file it came from. With the cache, this is the table of
+    profiles in the cached data (see `load_cached_instrmt`), with 'n_points',
+    the number of measurements with all of temp, salt, and p, so no data files
+    are read once the cache is up to date. Otherwise, just the header of each
+    data file is read. The rows are sorted by date so that it is also an index
+    of the profile times
+    Returns a pandas dataframe
+
+    source              A tuple of the data source, Ex: ('ITP', '2', 'cormat')
+    file_path           string of a file path to the containing directory
+    data_files          A list of the data file names in that directory
+    instrmt             string of the instrument that took the data in the files
+    format              The format of the data files
+    read_data_file      The function to use to read in each data file
+    workers             Optional number of processes to read the data files with
+    """
+    if use_cache:
+        profiles, arrays = load_cached_instrmt(source, file_path, data_files, instrmt, format, read_data_file, workers)
+        catalog = profiles[catalog_columns].copy()
+        catalog['n_points'] = profiles['n_complete'].values
+    else:
+        print('\t Cataloging',len(data_files),'files')
+        catalog = read_files_to_frame(file_path, data_files, instrmt, format, read_data_file, workers, metadata_only=True)
+        if isinstance(catalog, type(None)):
+            catalog = pd.DataFrame(columns=catalog_columns)
+    return sort_catalog(catalog)
+
+################################################################################
+
+def filter_catalog(catalog, filters):
+    """
+    Applies the filters in profile_filters to a catalog
+    Returns the rows of the catalog for the profiles that pass
+
+    catalog             A pandas dataframe with one row per profile, sorted by date
+    filters             A dictionary of the filters to apply
+                    Examples: {'region': {'bbox': [-160, -130, 72, 78]}},
+                              {'date_range': ['2005/08/01', '2005/10/01']}
+    """
+    if isinstance(filters, type(None)):
+        return catalog
+    # Date range filter
+    if 'date_range' in filters.keys():
+        catalog = find_date_range_rows(catalog, filters['date_range'])
+    # Region filter
+    if 'region' in filters.keys():
+        catalog = catalog[find_region_mask(catalog['lon'], catalog['lat'], filters['region'])]
+    return catalog
+
+################################################################################
+
+def find_date_range_rows(catalog, date_range):
+    """
+    Finds the profiles taken within a range of dates. The catalog is sorted by
+    date, so the first and last profiles in range are found by binary search
+    Returns the rows of the catalog for the profiles in that range, including
+    any taken exactly at the start or end of the range
+
+    catalog             A pandas dataframe with one row per profile, sorted by
+                        date with any missing dates at the end
+    date_range          A list of the start and end dates, as strings or datetimes
+                    Example: ['2005/08/01', '2005/10/01']
+    """
+    start = min(pd.Timestamp(date) for date in date_range)
+    end   = max(pd.Timestamp(date) for date in date_range)
+    # Only search the profiles that have dates
+    dates = catalog['date'].values[:catalog['date'].notnull().sum()]
+    i_start = np.searchsorted(dates, start.to_datetime64(), side='left')
+    i_end   = np.searchsorted(dates, end.to_datetime64(), side='right')
+    return catalog.iloc[i_start:i_end]
+
+################################################################################
+
+# The radius of the Earth in km
+earth_radius = 6371.0
+
+def polar_stereo_xy(lon, lat):
+    """
+    Projects longitudes and latitudes onto a plane tangent to the North Pole
+    with a polar stereographic projection. Distances in the plane are within a
+    few percent of the true distances across the Arctic
+    Returns arrays of the x and y values in km
+
+    lon, lat            Arrays of longitude and latitude values in degrees
+    """
+    lon = np.radians(np.array(lon, dtype=float))
+    lat = np.radians(np.array(lat, dtype=float))
+    rho = 2*earth_radius*np.tan(np.pi/4 - lat/2)
+    return rho*np.sin(lon), -rho*np.cos(lon)
+
+def sphere_xyz(lon, lat):
+    """
+    Finds the 3D positions of points on the surface of the Earth, taken as a
+    sphere. The straight line (chord) distance between two of these points
+    only depends on the great circle distance between them
+    Returns an array of the x, y, and z values in km, with one row per point
+
+    lon, lat            Arrays of longitude and latitude values in degrees
+    """
+    lon = np.radians(np.array(lon, dtype=float))
+    lat = np.radians(np.array(lat, dtype=float))
+    return earth_radius*np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+def find_region_mask(lon, lat, region):
+    """
+    Finds which profiles are within a region. Polygons are found with a KD-tree
+    of the profile locations in polar stereographic coordinates, and circles
+    with a KD-tree of their positions on the sphere, so the radius is an exact
+    great circle distance. Profiles with no location are never within a region
+    Returns a boolean array the same size as lon
+
+    lon, lat            Arrays of longitude and latitude values in degrees
+    region              A dictionary defining the region, one of:
+                    {'bbox': [lon_min, lon_max, lat_min, lat_max]}
+                    {'polygon': [(lon, lat), (lon, lat), ...]}
+                    {'center': (lon, lat), 'radius': radius in km}
+    """
+    lon = np.array(lon, dtype=float)
+    lat = np.array(lat, dtype=float)
+    known = np.isfinite(lon) & np.isfinite(lat)
+    if 'bbox' in region.keys():
+        lon_min, lon_max, lat_min, lat_max = region['bbox']
+        in_lat = (lat >= lat_min) & (lat <= lat_max)
+        if lon_min <= lon_max:
+            in_lon = (lon >= lon_min) & (lon <= lon_max)
+        else:
+            # The box crosses the dateline
+            in_lon = (lon >= lon_min) | (lon <= lon_max)
+        return known & in_lat & in_lon
+    mask = np.zeros(len(lon), dtype=bool)
+    if not known.any():
+        return mask
+    if 'polygon' in region.keys():
+        # Build the KD-tree of the known profile locations
+        x, y = polar_stereo_xy(lon[known], lat[known])
+        tree = cKDTree(np.column_stack([x, y]))
+        v_x, v_y = polar_stereo_xy(*np.array(region['polygon'], dtype=float).T)
+        # Only check the profiles within a circle around all the vertices
+        c_x, c_y = v_x.mean(), v_y.mean()
+        radius = np.hypot(v_x-c_x, v_y-c_y).max()
+        near = np.array(tree.query_ball_point([c_x, c_y], radius), dtype=int)
+        polygon = mpl.path.Path(np.column_stack([v_x, v_y]))
+        inside = near[polygon.contains_points(np.column_stack([x[near], y[near]]))]
+    elif 'center' in region.keys() and 'radius' in region.keys():
+        # The projection stretches distances away from the pole, so use the
+        #   straight line distance through the sphere that matches the radius
+        tree = cKDTree(sphere_xyz(lon[known], lat[known]))
+        chord = 2*earth_radius*np.sin(min(region['radius']/earth_radius, np.pi)/2)
+        inside = np.array(tree.query_ball_point(sphere_xyz(*region['center'])[0], chord), dtype=int)
+    else:
+        print('Region',region,'not valid')
+        exit(0)
+    mask[np.flatnonzero(known)[inside]] = True
+    return mask
+
+def sort_catalog(catalog):
+    """
+    Sorts a catalog by date, keeping the original order for profiles with the
+    same date and putting any profiles with no date at the end
+    Returns the sorted pandas dataframe
+
+    catalog             A pandas dataframe with one row per profile
+    """
+    dates = catalog['date']
+    # Skip the sort if it's already in order
+    n_dates = dates.notnull().sum()
+    if dates.iloc[:n_dates].notnull().all() and dates.iloc[:n_dates].is_monotonic_increasing:
+        return catalog
+    return catalog.sort_values(by='date', kind='mergesort', na_position='last', ignore_index=True)
+
+################################################################################
+
+def load_catalog_data(plt_dict, workers=None):
+    """
+    Finds the profiles specified and loads just their metadata from the catalog
+    into a pandas dataframe with one row per profile. This is much faster than
+    `load_data` for plots like maps which don't use any of the measurements
+
+    plt_dict        A dictionary of parameters needed to load and filter the data
+                    (see `load_data`). Only filters in catalog_filters are used
+    workers         Optional number of processes to read the data files with
+    """
+    # Get list of sources
+    data_sources = plt_dict['data_sources']
+    # Find the relevant filters and white_list
+    use_these_filters, white_list = find_filters(plt_dict)
+    # Create a blank list to add each catalog to
+    output_list = []
+    for source in data_sources:
+        source_type = source[0]
+        instrmt = source[1]
+        print('Loading catalog of',source_type,instrmt)
+        file_path, data_files, format, read_data_file = find_data_files(source)
+        catalog = load_catalog(source, file_path, data_files, instrmt, format, read_data_file, workers)
+        # Only keep the profiles on the white_list, if there is one
+        specific_white_list = find_specific_white_list(white_list, source_type, instrmt)
+        if not isinstance(specific_white_list, type(None)):
+            catalog = catalog[catalog['prof_no'].isin(specific_white_list)]
+        catalog = filter_catalog(catalog, use_these_filters)
+        # Profiles without any complete measurements are skipped by `load_data`
+        catalog = catalog[catalog['n_points'] > 0]
+        if len(catalog) > 0:
+            output_list.append(catalog)
     if len(output_list) > 0:
-        df = pd.concat(output_list)
-        return df
+        return combine_profiles(output_list)
     else:
         print('No profiles loaded, aborting script')
         exit(0)
@@ -283,10 +1562,192 @@ def filter_data(data, filters):
         # Sort values to avoid issues with endpoints
         df = df.sort_values(by='p')
         # Add a note to remember which direction was kept
-        df['notes'] = df['notes']+'-'+direction
+        df['notes'] = df['notes'].astype('category').cat.rename_categories(lambda note: note+'-'+direction)
     #
     return df
 
+################################################################################
+
+def filter_data_batch(data, filters):
+    """
+    Filters the data for many profiles at once, giving exactly the same
+    profiles as calling `filter_data` on each profile separately. The cast
+    direction is found with a first difference within each profile, and the
+    profiles left with too few points are found by counting the rows of each
+    Returns a pandas dataframe, sorted by 'pf_key' and then by p if there is a
+    'cast_direction' filter
+
+    data            A pandas dataframe with a 'pf_key' column numbering its
+                    profiles, and the columns that `filter_data` needs
+    filters             A dictionary of the filters to apply
+                    Examples: {'p_range': [260,280]}, {'p_range': [260,280], 'cast_direction': 'up'}
+    """
+    # Keep the rows of each profile together, in their original order
+    if not data['pf_key'].is_monotonic_increasing:
+        data = data.iloc[np.argsort(np.asarray(data['pf_key']), kind='mergesort')]
+    # Check for filters
+    if isinstance(filters, type(None)):
+        # Remove rows of the data frame with missing data
+        return data[data.temp.notnull() & data.salt.notnull() & data.p.notnull()]
+    # Remove rows with missing data and apply the range filters
+    df = data[find_range_mask(filters, data['temp'].values, data['salt'].values, data['p'].values)]
+    #
+    # Filter by direction of cast: up or down
+    if 'cast_direction' in filters.keys():
+        # Get direction of filter (either 'up' or 'down')
+        #   Note: staircases are generally better resolved by up-casts
+        #         because down-casts have wake issues
+        direction = filters['cast_direction']
+        pf_keys = np.asarray(df['pf_key'])
+        p = np.asarray(df['p'], dtype=float)
+        # Find the first difference of depth values within each profile
+        res = np.diff(p, prepend=np.nan)
+        new_pf = np.ones(len(p), dtype=bool)
+        new_pf[1:] = pf_keys[1:] != pf_keys[:-1]
+        # Delete the first row of each profile because it has no difference
+        keep = ~new_pf
+        # Filter by direction
+        if direction == 'up':
+            # If the first differences are negative, depth is decreasing
+            #   therefore the cast is going up. Only keep such values
+            keep &= res < 0
+        elif direction == 'down':
+            # If the first differences are positive, depth is increasing
+            #   therefore the cast is going down. Only keep such values
+            keep &= res > 0
+        df = df[keep]
+        # Make sure there are still enough points in each profile to be useful
+        all_keys = np.unique(np.asarray(data['pf_key']))
+        n_points = np.bincount(np.asarray(df['pf_key']), minlength=all_keys.max()+1 if len(all_keys) > 0 else 0)
+        too_few = all_keys[n_points[all_keys] < 10]
+        if len(too_few) > 0:
+            prof_nos = data.loc[~data['pf_key'].duplicated(), ['pf_key', 'prof_no']].set_index('pf_key')['prof_no']
+            for pf_key in too_few:
+                print('Not enough points in profile',np.array([prof_nos[pf_key]]),'after filtering to',direction,'direction')
+            df = df[~np.isin(np.asarray(df['pf_key']), too_few)]
+        # Sort values within each profile to avoid issues with endpoints
+        order = np.lexsort((np.asarray(df['p']), np.asarray(df['pf_key'])))
+        df = df.iloc[order]
+        # Add a note to remember which direction was kept
+        df = df.assign(notes=df['notes'].astype('category').cat.rename_categories(lambda note: note+'-'+direction))
+    #
+    return df
+
+################################################################################
+
+def grid_profiles(data, spacing):
+    """
+    Regrids every profile in the data onto pressure levels at a uniform
+    spacing by linear interpolation, the same as `np.interp` on each profile.
+    All the profiles are interpolated at once: the depths of each profile are
+    shifted so that each profile is further down than the last, and then one
+    search finds where every level of every profile falls
+    Returns three things:
+    profiles        A pandas dataframe with one row per profile, with 'pf_key',
+                    the columns in profile_columns, and 'n_points', the number of
+                    measurements in the profile before regridding
+    levels          An array of the pressure levels, which are multiples of the
+                    spacing covering the depths of all the profiles
+    grids           A dictionary of 2D arrays of 'temp' and 'salt', with one row
+                    per profile and one column per level, and NaN for the levels
+                    outside of each profile
+
+    data            A pandas dataframe with a 'pf_key' column, without missing
+                    values, such as from `combine_profiles`
+    spacing         The spacing of the levels, in the units of p
+    """
+    # Sort by profile, then by depth within each profile
+    pf_keys = np.asarray(data['pf_key'])
+    p = np.asarray(data['p'], dtype=float)
+    order = np.lexsort((p, pf_keys))
+    keys, pf = np.unique(pf_keys[order], return_inverse=True)
+    p = p[order]
+    n_pfs = len(keys)
+    starts = np.searchsorted(pf, np.arange(n_pfs), side='left')
+    ends   = np.searchsorted(pf, np.arange(n_pfs), side='right')
+    # Use the same levels for every profile
+    if len(p) > 0:
+        p_lo, p_hi = p.min(), p.max()
+    else:
+        p_lo, p_hi = 0.0, 0.0
+    k_min = int(np.ceil(p_lo/spacing - 1e-9))
+    k_max = int(np.floor(p_hi/spacing + 1e-9))
+    levels = np.round(spacing*np.arange(k_min, k_max+1), 10)
+    n_levels = len(levels)
+    # Shift each profile down by more than the whole range of depths
+    shift = (p_hi - p_lo) + 2*spacing
+    shifted_p = (p - p_lo) + pf*shift
+    shifted_levels = ((levels - p_lo)[np.newaxis,:] + (np.arange(n_pfs)*shift)[:,np.newaxis]).ravel()
+    # Find the measurements on either side of each level of each profile
+    level_pf = np.repeat(np.arange(n_pfs), n_levels)
+    level_p  = np.tile(levels, n_pfs)
+    pf_start = starts[level_pf]
+    pf_end   = ends[level_pf]
+    valid = (pf_end - pf_start >= 2) & (level_p >= p[pf_start]) & (level_p <= p[pf_end-1])
+    right = np.searchsorted(shifted_p, shifted_levels, side='right')
+    left = np.where(valid, np.clip(right-1, pf_start, pf_end-2), 0)
+    right = np.where(valid, left+1, 0)
+    # Find how far each level is between the measurements on either side
+    dp = p[right] - p[left]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(dp > 0, (level_p - p[left])/dp, 0.0)
+    grids = {}
+    for var in ['temp', 'salt']:
+        values = np.asarray(data[var], dtype=float)[order]
+        grid = values[left] + weight*(values[right] - values[left])
+        grid[~valid] = np.nan
+        grids[var] = grid.reshape(n_pfs, n_levels).astype(data[var].dtype)
+    # Take the metadata of each profile from its first row
+    profiles = data.iloc[order[starts]][profile_columns].reset_index(drop=True)
+    profiles.insert(0, 'pf_key', np.arange(n_pfs, dtype=np.int32))
+    profiles['n_points'] = ends - starts
+    return profiles, levels, grids
+
+def gridded_to_frame(profiles, levels, grids):
+    """
+    Turns regridded profiles back into a data frame with one row per level of
+    each profile, leaving out the levels outside of each profile
+    Returns a pandas dataframe with the same columns as `combine_profiles`
+
+    profiles            The pandas dataframe of profiles from `grid_profiles`
+    levels              The array of pressure levels from `grid_profiles`
+    grids               The dictionary of 2D arrays from `grid_profiles`
+    """
+    # Rows in order of profile, then level
+    rows, cols = np.nonzero(np.isfinite(grids['temp']) & np.isfinite(grids['salt']))
+    out_dict = {}
+    for col in profile_columns:
+        out_dict[col] = profiles[col].values.take(rows)
+    for var in grids.keys():
+        out_dict[var] = grids[var][rows, cols]
+    out_dict['p'] = levels[cols].astype(grids['temp'].dtype)
+    df = pd.DataFrame(out_dict)
+    df['pf_key'] = np.asarray(profiles['pf_key'])[rows]
+    return df
+
+################################################################################
+
+def find_range_mask(filters, temp, salt, p):
+    """
+    Finds which measurements pass the p_range, T_range, and S_range filters,
+    using the raw arrays from a data file so that the out of range values can
+    be dropped before a data frame is built. Values that are missing in any of
+    the arrays never pass. This matches what `filter_data` does with the
+    same filters, so the profile is the same either way
+    Returns a boolean array the same size as temp
+
+    filters             A dictionary of the filters to apply
+    temp                An array of temperature values
+    salt                An array of salinity values
+    p                   An array of depth values (in m or dbar)
+    """
+    mask = pd.notnull(temp) & pd.notnull(salt) & pd.notnull(p)
+    # Check each range filter against its own array
+    for key, values in [('p_range', p), ('T_range', temp), ('S_range', salt)]:
+        if key in filters.keys():
+            mask &= (values < max(filters[key])) & (values > min(filters[key]))
+    return mask
+
 ################################################################################
 # Don't use the profiles specified below because they have errors
 black_list = {'BigBear': [531, 535, 537, 539, 541, 543, 545, 547, 549],
@@ -296,7 +1757,7 @@ black_list = {'BigBear': [531, 535, 537, 539, 541, 543, 545, 547, 549],
 
 ################################################################################
 
-def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list):
+def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list, filters=None, metadata_only=False):
     """
     Reads certain data from an AIDJEX profile file
     Returns an array of strings
@@ -306,6 +1767,8 @@ def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list):
     instrmt             string of the instrument that took the data in the file
     format              Irrelevant for AIDJEX data
     white_list          Optional list of profile numbers to actually load
+    filters             Optional dictionary of the range filters to apply
+    metadata_only       If True, only return the catalog entry for the profile
     """
     # Assuming file name format instrmt_YYY where the profile number,
     #   YYY, is always 3 digits
@@ -321,19 +1784,19 @@ def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list):
     # Declare variables
     lon = None
     lat = None
-    # Read data file in as a pandas data object
-    #   The arguments used are specific to how the AIDJEX files are formatted
-    #   Reading in the file one line at a time because the number of items
-    #       on each line is inconsistent between files
-    dat0 = pd.read_table(file_path+'/'+file_name, header=None, nrows=1, engine='python', delim_whitespace=True).iloc[0]
-    dat1 = pd.read_table(file_path+'/'+file_name, header=0, nrows=1, engine='python', delim_whitespace=True).iloc[0]
+    # Read the whole file in at once, then split it into lines, or just the
+    #   header lines for the catalog
+    #   Skip blank lines, to match how pandas counts header lines
+    with open_data_file(file_path, file_name, 'r') as f:
+        if metadata_only:
+            lines = read_header_lines(f, 2)
+        else:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+    # The number of items on each of the header lines is inconsistent between
+    #   files, so split them up individually
+    dat0 = lines[0].split()
+    dat1 = lines[1].split()
     # Extract certain data from the object, specific to how the files are formatted
-    #   instrmt name
-    #       Split the file name at a '/' and take the last chunk
-    temp = file_name.split('/')[-1]
-    #       Use a regular expression to remove all digits after splitting at a
-    #       '/' and taking the second chunk
-    # instrmt = re.sub(r'[0-9]', '', temp.split('_')[0])
     #   The date this profile was taken
     date_string = dat0[3]
     #   The time this profile was taken
@@ -355,27 +1818,27 @@ def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list):
     if lat == 99.9999 and lon == 99.9999:
         lat = None
         lon = None
-    # Read in data from the file
-    dat = pd.read_table(file_path+'/'+file_name,header=3,skipfooter=0,engine='python',delim_whitespace=True)
+    # The 4th line has the column headers and the data starts on the 5th line
+    if metadata_only:
+        # The catalog only needs the header
+        return make_catalog_row('AIDJEX', instrmt, prof_no, lon, lat, date, format, '')
+    dat = read_data_table(lines[4:], lines[3].split(), ['Depth(m)', 'Temp(C)', 'Sal(PPT)'])
     # If it finds the correct column headers, put data into arrays
-    if 'Depth(m)' and 'Temp(C)' and 'Sal(PPT)' in dat.columns:
-        temp0 = dat['Temp(C)'][:].values
-        salt0 = dat['Sal(PPT)'][:].values
-        p0    = dat['Depth(m)'][:].values
-        out_dict = {'source': ['AIDJEX']*len(temp0), # needs to be an array the same size as temp
-                    'instrmt': [instrmt]*len(temp0), # needs to be an array the same size as temp
-                    'prof_no': [str(prof_no)]*len(temp0), # needs to be an array the same size as temp
-                    'lon': [lon]*len(temp0), # needs to be an array the same size as temp
-                    'lat': [lat]*len(temp0), # needs to be an array the same size as temp
-                    'date': [date]*len(temp0), # needs to be an array the same size as temp
-                    'format': [format]*len(temp0), # needs to be an array the same size as temp
-                    'notes': ['']*len(temp0), # needs to be an array the same size as temp
-                    'temp': temp0,
-                    'salt': salt0,
-                    'p': p0
-                    }
+    if not isinstance(dat, type(None)):
+        temp0 = dat['Temp(C)']
+        salt0 = dat['Sal(PPT)']
+        p0    = dat['Depth(m)']
+        # Apply any range filters before building the data frame
+        if not isinstance(filters, type(None)):
+            in_range = find_range_mask(filters, temp0, salt0, p0)
+            # Skip this profile if none of it is within range
+            if not in_range.any():
+                return None
+            temp0 = temp0[in_range]
+            salt0 = salt0[in_range]
+            p0    = p0[in_range]
         # Build output data frame
-        df = pd.DataFrame(out_dict)
+        df = make_profile_df('AIDJEX', instrmt, prof_no, lon, lat, date, format, '', temp0, salt0, p0)
         # Return all the relevant values
         return df
     else:
@@ -383,7 +1846,49 @@ def read_AIDJEX_data_file(file_path, file_name, instrmt, format, white_list):
 
 ################################################################################
 
-def read_ITP_data_file(file_path, file_name, instrmt, format, white_list):
+def read_header_lines(f, n_lines):
+    """
+    Reads just the first few lines of a text file, skipping blank lines, so the
+    rest of the file is never read
+    Returns a list of the lines as strings
+
+    f                   An open text file object
+    n_lines             The number of lines to read
+    """
+    lines = []
+    for line in f:
+        if line.strip():
+            lines.append(line.rstrip('\r\n'))
+            if len(lines) == n_lines:
+                break
+    return lines
+
+def read_data_table(lines, col_names, use_cols):
+    """
+    Parses lines of whitespace separated numbers into arrays of floats, using
+    numpy's C parser and only falling back to pandas if the rows are ragged
+    Returns a dictionary of arrays, one for each column in use_cols, or None if
+    any of those columns are missing
+
+    lines               A list of strings, one for each row of data
+    col_names           A list of the column headers, in order
+    use_cols            A list of the column headers to return
+    """
+    # Make sure all the columns asked for are actually there
+    if not all(col in col_names for col in use_cols):
+        return None
+    col_indices = [col_names.index(col) for col in use_cols]
+    try:
+        dat = np.loadtxt(lines, usecols=col_indices, ndmin=2, dtype=float)
+        return {col: dat[:,i] for i, col in enumerate(use_cols)}
+    except ValueError:
+        # Rows with missing values end up as NaN with pandas
+        dat = pd.read_csv(StringIO('\n'.join(lines)), sep=r'\s+', header=None, names=col_names, usecols=use_cols, engine='c')
+        return {col: dat[col].values for col in use_cols}
+
+################################################################################
+
+def read_ITP_data_file(file_path, file_name, instrmt, format, white_list, filters=None, metadata_only=False):
     """
     Reads certain data from an ITP profile file
     Returns a pandas dataframe
@@ -393,6 +1898,8 @@ def read_ITP_data_file(file_path, file_name, instrmt, format, white_list):
     instrmt             string of the instrument that took the data in the file
     format              either 'cormat' or 'final'
     white_list          Optional list of profile numbers to actually load
+    filters             Optional dictionary of the range filters to apply
+    metadata_only       If True, only return the catalog entry for the profile
     """
     # Make sure it isn't a 'sami' file instead of a 'grd' file
     if 'sami' in file_name:
@@ -433,9 +1940,9 @@ def read_ITP_data_file(file_path, file_name, instrmt, format, white_list):
         load_itp = load_cormat_itp
     #
     # print('    Loading file',file_name)
-    return load_itp(file_path, file_name, instrmt, prof_no)
+    return load_itp(file_path, file_name, instrmt, prof_no, filters, metadata_only)
 
-def load_final_itp(file_path, file_name, instrmt, prof_no):
+def load_final_itp(file_path, file_name, instrmt, prof_no, filters=None, metadata_only=False):
     """
     Loads the data from an ITP profile file in the `final` format
     Returns a pandas dataframe
@@ -444,15 +1951,23 @@ def load_final_itp(file_path, file_name, instrmt, prof_no):
     file_name           string of the file name of a specific file
     instrmt             The number of the ITP that took the profile measurement
     prof_no             The number identifying this specific profile
+    filters             Optional dictionary of the range filters to apply
+    metadata_only       If True, only return the catalog entry for the profile
     """
     # Check instrument and profile number and skip if it's a down-cast
     #   Nevermind, `final` profiles are sorted, so there's no way to tell
     #   if it is an up or down cast
-    # Read data file in as a pandas data object
-    #   The arguments used are specific to how the ITP files are formatted
-    #   Reading in the file one line at a time because the number of items
-    #       on each line is inconsistent between files
-    dat0 = pd.read_table(file_path+'/'+file_name, header=None, nrows=2, engine='python', delim_whitespace=True).iloc[1]
+    # Read the whole file in at once, then split it into lines, or just the
+    #   header lines for the catalog
+    #   Skip blank lines, to match how pandas counts header lines
+    with open_data_file(file_path, file_name, 'r') as f:
+        if metadata_only:
+            lines = read_header_lines(f, 2)
+        else:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+    # The number of items on each of the header lines is inconsistent between
+    #   files, so split the line with the date and location individually
+    dat0 = lines[1].split()
     # Extract certain data from the object, specific to how the files are formatted
     #   The date this profile was taken
     try:
@@ -462,31 +1977,32 @@ def load_final_itp(file_path, file_name, instrmt, prof_no):
     #   The latitude and longitude values where the profile was taken
     lon = float(dat0[2])
     lat = float(dat0[3])
-    # Read in data from the file
-    dat = pd.read_table(file_path+'/'+file_name,header=2,skipfooter=1,engine='python',delim_whitespace=True)
+    # The 3rd line has the column headers, the data starts on the 4th line, and
+    #   the last line is a footer that marks the end of the data
+    if metadata_only:
+        # The catalog only needs the header
+        return make_catalog_row('ITP', instrmt, prof_no, lon, lat, date, 'final', '')
+    dat = read_data_table(lines[3:-1], lines[2].split(), ['%pressure(dbar)', 'temperature(C)', 'salinity'])
     # If it finds the correct column headers, put data into arrays
-    if 'temperature(C)' and 'salinity' and '%pressure(dbar)' in dat.columns:
-        temp0 = dat['temperature(C)'][:].values
-        salt0 = dat['salinity'][:].values
-        p0    = dat['%pressure(dbar)'][:].values
-        out_dict = {'source': ['ITP']*len(temp0), # needs to be an array the same size as temp
-                    'instrmt': [instrmt]*len(temp0), # needs to be an array the same size as temp
-                    'prof_no': [str(prof_no)]*len(temp0), # needs to be an array the same size as temp
-                    'lon': [lon]*len(temp0), # needs to be an array the same size as temp
-                    'lat': [lat]*len(temp0), # needs to be an array the same size as temp
-                    'date': [date]*len(temp0), # needs to be an array the same size as temp
-                    'format': ['final']*len(temp0), # needs to be an array the same size as temp
-                    'notes': ['']*len(temp0), # needs to be an array the same size as temp
-                    'temp': temp0,
-                    'salt': salt0,
-                    'p': p0
-                    }
+    if not isinstance(dat, type(None)):
+        temp0 = dat['temperature(C)']
+        salt0 = dat['salinity']
+        p0    = dat['%pressure(dbar)']
+        # Apply any range filters before building the data frame
+        if not isinstance(filters, type(None)):
+            in_range = find_range_mask(filters, temp0, salt0, p0)
+            # Skip this profile if none of it is within range
+            if not in_range.any():
+                return None
+            temp0 = temp0[in_range]
+            salt0 = salt0[in_range]
+            p0    = p0[in_range]
         # Build output data frame
-        df = pd.DataFrame(out_dict)
+        df = make_profile_df('ITP', instrmt, prof_no, lon, lat, date, 'final', '', temp0, salt0, p0)
         # Return all the relevant values
         return df
 
-def load_cormat_itp(file_path, file_name, instrmt, prof_no):
+def load_cormat_itp(file_path, file_name, instrmt, prof_no, filters=None, metadata_only=False):
     """
     Loads the data from an ITP profile file in the `cormat` format
     Returns a pandas dataframe
@@ -495,13 +2011,15 @@ def load_cormat_itp(file_path, file_name, instrmt, prof_no):
     file_name           string of the file name of a specific file
     instrmt             The number of the ITP that took the profile measurement
     prof_no             The number identifying this specific profile
+    filters             Optional dictionary of the range filters to apply
+    metadata_only       If True, only return the catalog entry for the profile
     """
-    # Load cormat file into dictionary with mat73
-    #   (specific to version of MATLAB used to make cormat files)
-    try:
-        dat = mat73.loadmat(file_path+'/'+file_name)
-    except:
-        dat = io.loadmat(file_path+'/'+file_name)
+    # Load cormat file into dictionary, using the reader for the version of
+    #   MATLAB used to make the file. Only read the variables that are used
+    if metadata_only:
+        dat = load_mat_file(file_path, file_name, cormat_catalog_vars)
+    else:
+        dat = load_mat_file(file_path, file_name, cormat_vars)
     # print(dat)
     # exit(0)
     # Extract certain data from the object, specific to how the files are formatted
@@ -526,6 +2044,13 @@ def load_cormat_itp(file_path, file_name, instrmt, prof_no):
     lat = float(dat['latitude'])
     # print('lon:',type(lon))
     # print('lat:',type(lat))
+    # The catalog doesn't need the temperature and salinity values
+    if metadata_only and 'pr_filt' in dat:
+        p0 = dat['pr_filt'].flatten()
+        # Down-casts are skipped in the catalog too
+        if p0[0] < p0[-1]:
+            return None
+        return make_catalog_row('ITP', instrmt, prof_no, lon, lat, date, 'cormat', '')
     # If it finds the correct column headers, put data into arrays
     if 'te_adj' in dat and 'sa_adj' in dat and 'pr_filt' in dat:
         temp0 = dat['te_adj'].flatten()
@@ -541,36 +2066,148 @@ def load_cormat_itp(file_path, file_name, instrmt, prof_no):
             return None
         # else:
         #     print('prof:',prof_no,'goes from',p0[0],'to',p0[-1])
-        out_dict = {'source': ['ITP']*len(temp0), # needs to be an array the same size as temp
-                    'instrmt': [instrmt]*len(temp0), # needs to be an array the same size as temp
-                    'prof_no': [str(prof_no)]*len(temp0), # needs to be an array the same size as temp
-                    'lon': [lon]*len(temp0), # needs to be an array the same size as temp
-                    'lat': [lat]*len(temp0), # needs to be an array the same size as temp
-                    'date': [date]*len(temp0), # needs to be an array the same size as temp
-                    'format': ['cormat']*len(temp0), # needs to be an array the same size as temp
-                    'notes': ['']*len(temp0), # needs to be an array the same size as temp
-                    'temp': temp0,
-                    'salt': salt0,
-                    'p': p0
-                    }
+        # Apply any range filters before building the data frame
+        if not isinstance(filters, type(None)):
+            in_range = find_range_mask(filters, temp0, salt0, p0)
+            # Skip this profile if none of it is within range
+            if not in_range.any():
+                return None
+            temp0 = temp0[in_range]
+            salt0 = salt0[in_range]
+            p0    = p0[in_range]
         # Build output data frame
-        df = pd.DataFrame(out_dict)
+        df = make_profile_df('ITP', instrmt, prof_no, lon, lat, date, 'cormat', '', temp0, salt0, p0)
         # Return all the relevant values
         return df
 
+################################################################################
+
+# The only variables used from each ITP `cormat` file
+cormat_vars = ['psdate', 'pstart', 'latitude', 'longitude', 'te_adj', 'sa_adj', 'pr_filt']
+# The only variables needed for the catalog from each ITP `cormat` file
+cormat_catalog_vars = ['psdate', 'pstart', 'latitude', 'longitude', 'pr_filt']
+# The signature at the start of every HDF5 file, which is what MATLAB v7.3 uses
+hdf5_signature = b'\x89HDF\r\n\x1a\n'
+# The format of the .mat files found in each directory so far, either 'v7.3',
+#   'v5', or 'mixed' if a directory has files of both formats
+mat_formats = {}
+
+def find_mat_format(file_path, file_name):
+    """
+    Reads just the header of a .mat file to find out what format it is in
+    Returns 'v7.3' for HDF5 files, or 'v5' for anything scipy can read
+
+    file_path           string of a file path to the containing directory
+    file_name           string of the file name of a specific file
+    """
+    with open_data_file(file_path, file_name, 'rb') as f:
+        header = f.read(520)
+    # MATLAB v7.3 files have a 512 byte text header before the HDF5 signature
+    if header[:8] == hdf5_signature or header[512:520] == hdf5_signature:
+        return 'v7.3'
+    # Otherwise, expect the 'MATLAB 5.0 MAT-file' text header (or no header at
+    #   all for the even older v4 files, which scipy can also read)
+    return 'v5'
+
+def load_mat_file(file_path, file_name, var_names=None):
+    """
+    Loads a .mat file with the reader that matches its format. The format is
+    remembered for each directory so most files don't need to be checked first
+    Returns a dictionary of the variables in the file
+
+    file_path           string of a file path to the containing directory
+    file_name           string of the file name of a specific file
+    var_names           Optional list of the only variables to read
+    """
+    mat_format = mat_formats.get(file_path)
+    # Check the format of this file if the directory is new or mixed
+    if mat_format in [None, 'mixed']:
+        file_format = find_mat_format(file_path, file_name)
+        if isinstance(mat_format, type(None)):
+            mat_formats[file_path] = file_format
+        mat_format = file_format
+    try:
+        return read_mat_file(file_path, file_name, mat_format, var_names)
+    except:
+        # If the format doesn't match the rest of the directory, remember to
+        #   check every file in this directory from now on
+        file_format = find_mat_format(file_path, file_name)
+        if file_format == mat_format:
+            raise
+        mat_formats[file_path] = 'mixed'
+        return read_mat_file(file_path, file_name, file_format, var_names)
+
+def read_mat_file(file_path, file_name, mat_format, var_names=None):
+    """
+    Loads a .mat file of a known format
+    Returns a dictionary of the variables in the file
+
+    file_path           string of a file path to the containing directory
+    file_name           string of the file name of a specific file
+    mat_format          Either 'v7.3' or 'v5', as found by `find_mat_format`
+    var_names           Optional list of the only variables to read
+    """
+    # Give the readers the path unless the file was read ahead, so they only
+    #   read the parts of the file they need
+    file_bytes = prefetched_files.get(file_path+'/'+file_name)
+    if isinstance(file_bytes, type(None)):
+        f = file_path+'/'+file_name
+    else:
+        f = BytesIO(file_bytes)
+    if mat_format == 'v7.3':
+        return read_hdf5_mat_file(f, var_names)
+    else:
+        return io.loadmat(f, variable_names=var_names)
+
+def read_hdf5_mat_file(path, var_names=None):
+    """
+    Reads variables straight out of a MATLAB v7.3 (HDF5) file with h5py, so any
+    other variables in the file are never read or decoded
+    Returns a dictionary of the variables in the file, with text as strings and
+    numbers as arrays, squeezed down to the fewest dimensions
+
+    path                string of the path to the file, or a file object
+    var_names           Optional list of the only variables to read
+    """
+    dat = {}
+    with h5py.File(path, 'r') as f:
+        if isinstance(var_names, type(None)):
+            var_names = [key for key in f.keys() if not key.startswith('#')]
+        for var in var_names:
+            if var not in f or not isinstance(f[var], h5py.Dataset):
+                continue
+            ds = f[var]
+            # MATLAB stores empty arrays as their dimensions instead
+            if ds.attrs.get('MATLAB_empty', 0):
+                dat[var] = np.array([])
+                continue
+            # MATLAB stores arrays in column major order, so transpose them
+            value = ds[()].T
+            mat_class = ds.attrs.get('MATLAB_class', b'')
+            if isinstance(mat_class, bytes):
+                mat_class = mat_class.decode()
+            if mat_class == 'char':
+                # Text is stored as an array of UTF-16 character codes
+                dat[var] = ''.join(map(chr, value.flatten()))
+            else:
+                dat[var] = np.squeeze(value)
+    return dat
+
 ################################################################################
 ################################################################################
 # Admin functions for plotting
 ################################################################################
 ################################################################################
 
-def make_plots(to_plot, filename=None):
+def make_plots(to_plot, filename=None, workers=None):
     """
     Takes in a list of dictionaries, one for each subplot. Determines the needed
     arrangement of subplots, then passes one dictionary to each axis for plotting
 
     to_plot         A list of dictionaries, one for each subplot
                     Each dictionary contains the info to create each subplot
+    filename        Optional file name to save the figure to
+    workers         Optional number of processes to read the data files with
     """
     # Define number of rows and columns based on number of subplots
     #   key: number of subplots, value: (rows, cols, f_ratio, f_size)
@@ -581,20 +2218,31 @@ def make_plots(to_plot, filename=None):
     n_subplots = len(to_plot)
     if n_subplots == 1:
         fig, ax = set_fig_axes([1], [1], fig_ratio=0.8, fig_size=1.25)
-        xlabel, ylabel, plt_title, ax = make_plot(ax, to_plot[0], fig, 111)
+        xlabel, ylabel, plt_title, ax = make_plot(ax, to_plot[0], fig, 111, workers)
         ax.set_xlabel(xlabel)
         ax.set_ylabel(ylabel)
         ax.set_title(plt_title)
     elif n_subplots > 1 and n_subplots < 7:
         rows, cols, f_ratio, f_size = n_row_col_dict[str(n_subplots)]
         fig, axes = set_fig_axes([1]*rows, [1]*cols, fig_ratio=f_ratio, fig_size=f_size, share_y_axis=False)
+        # Find which subplots need the same data, so it is only loaded once
+        data_keys = [find_data_key(plt_dict) for plt_dict in to_plot]
+        shared_data = {}
         for i in range(n_subplots):
             if rows > 1:
                 i_ax = (i//cols,i%cols)
             else:
                 i_ax = i
             ax_pos = int(str(rows)+str(cols)+str(i+1))
-            xlabel, ylabel, plt_title, ax = make_plot(axes[i_ax], to_plot[i], fig, ax_pos)
+            data = None
+            if data_keys.count(data_keys[i]) > 1:
+                if data_keys[i] not in shared_data.keys():
+                    shared_data[data_keys[i]] = load_plot_data(to_plot[i], workers)
+                data = shared_data[data_keys[i]]
+                # Let go of the data after the last subplot that needs it
+                if data_keys[i] not in data_keys[i+1:]:
+                    del shared_data[data_keys[i]]
+            xlabel, ylabel, plt_title, ax = make_plot(axes[i_ax], to_plot[i], fig, ax_pos, workers, data)
             ax.set_xlabel(xlabel)
             ax.set_ylabel(ylabel)
             ax.set_title(plt_title)
@@ -617,7 +2265,7 @@ def make_plots(to_plot, filename=None):
 
 ################################################################################
 
-def make_plot(ax, plt_dict, fig, ax_pos):
+def make_plot(ax, plt_dict, fig, ax_pos, workers=None, data=None):
     """
     Takes in a dictionary of plotting parameters and produces the plot as
     specified by those parameters. Returns the x and y labels
@@ -626,14 +2274,140 @@ def make_plot(ax, plt_dict, fig, ax_pos):
     plt_dict        A dictionary containing the info to create this subplot
     fig             The figure in which ax is contained
     ax_pos          A tuple of the ax (rows, cols, linear number of this subplot)
+    workers         Optional number of processes to read the data files with
+    data            Optional pandas dataframe of data already loaded for this
+                    subplot by `load_plot_data`
     """
-    # Load data into a pandas data frame and apply filters
-    data = load_data(plt_dict)
+    if isinstance(data, type(None)):
+        if use_streaming(plt_dict) and not use_catalog(plt_dict) and find_data_key(plt_dict) not in dataset_cache.keys():
+            # Plots that can be drawn one instrument at a time never load all
+            #   the data at once, unless it is already in memory
+            return plot_data_batches(ax, iter_load_data(plt_dict, workers), plt_dict, fig, ax_pos)
+        # Load data into a pandas data frame and apply filters
+        data = load_plot_data(plt_dict, workers)
     # Plot the data in the specified manner
     #   Returns the x and y labels for this axis
     xlabel, ylabel, plt_title, ax = plot_data(ax, data, plt_dict, fig, ax_pos)
     return xlabel, ylabel, plt_title, ax
 
+def load_plot_data(plt_dict, workers=None):
+    """
+    Loads the data needed for one subplot, using the catalog for plots that
+    only need the metadata of each profile. The data is kept in memory, so the
+    next subplot with the same data sources and filters doesn't load it again
+    Returns a pandas dataframe, which may be the data kept in memory, so it
+    must not be changed in place
+
+    plt_dict        A dictionary containing the info to create this subplot
+    workers         Optional number of processes to read the data files with
+    """
+    data_key = find_data_key(plt_dict)
+    data = get_cached_dataset(data_key)
+    if not isinstance(data, type(None)):
+        return data
+    if use_catalog(plt_dict):
+        data = load_catalog_data(plt_dict, workers)
+    else:
+        data = load_data(plt_dict, workers)
+    cache_dataset(data_key, data)
+    return data
+
+################################################################################
+
+# The data kept in memory between plots, by the key from `find_data_key`,
+#   with the least recently used first. Each value is the data frame and its
+#   size in bytes
+dataset_cache = OrderedDict()
+dataset_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_cached_dataset(data_key):
+    """
+    Looks up data kept in memory by `cache_dataset`. Note that the data is not
+    reloaded if the data files change, use `clear_dataset_cache` for that
+    Returns the pandas dataframe, or None if that data isn't in memory. This
+    is the data kept in memory and not a copy, so to not change it for later
+    plots, it must not be changed in place
+
+    data_key        The key of the data, from `find_data_key`
+    """
+    if data_key in dataset_cache.keys():
+        dataset_cache_stats['hits'] += 1
+        # Mark this data as the most recently used
+        dataset_cache.move_to_end(data_key)
+        return dataset_cache[data_key][0]
+    dataset_cache_stats['misses'] += 1
+    return None
+
+def cache_dataset(data_key, data):
+    """
+    Keeps data in memory for later plots. If that goes over the memory budget,
+    dataset_cache_budget, the least recently used data is dropped until it fits
+
+    data_key        The key of the data, from `find_data_key`
+    data            A pandas dataframe
+    """
+    budget = dataset_cache_budget*1e6
+    size = data.memory_usage(index=True, deep=True).sum()
+    # Don't bother with data that would never fit
+    if size > budget:
+        return
+    dataset_cache[data_key] = (data, size)
+    while sum(value[1] for value in dataset_cache.values()) > budget:
+        dataset_cache.popitem(last=False)
+        dataset_cache_stats['evictions'] += 1
+
+def dataset_cache_info():
+    """
+    Reports how well the data kept in memory is being used, to help in setting
+    dataset_cache_budget
+    Returns a dictionary with the number of hits, misses, and evictions, the
+    number of data frames in memory, and their total size and the budget in MB
+    """
+    info = dict(dataset_cache_stats)
+    info['datasets'] = len(dataset_cache)
+    info['size_MB'] = sum(value[1] for value in dataset_cache.values())/1e6
+    info['budget_MB'] = dataset_cache_budget
+    return info
+
+def clear_dataset_cache():
+    """
+    Drops all the data kept in memory and resets the statistics
+    """
+    dataset_cache.clear()
+    for key in dataset_cache_stats.keys():
+        dataset_cache_stats[key] = 0
+
+def find_data_key(plt_dict):
+    """
+    Makes a key for the data that a subplot needs, from its data sources, its
+    filters, and whether it uses the catalog. Subplots with the same key would
+    load exactly the same data
+    Returns a string
+
+    plt_dict        A dictionary containing the info to create this subplot
+    """
+    # Numbers and strings are both allowed for instruments, Ex: 3 and '3'
+    sources = [tuple(str(item) for item in source) for source in plt_dict['data_sources']]
+    use_these_filters, white_list = find_filters(plt_dict)
+    return repr((use_catalog(plt_dict), sources, normalize_spec(use_these_filters)))
+
+def normalize_spec(spec):
+    """
+    Puts a dictionary of filters into a standard form so that equivalent
+    filters compare the same, Ex: {'p_range': [200, 300]} and {'p_range': (200.0, 300.0)}
+    Returns the filters with sorted dictionary keys, lists as tuples, and
+    numbers as floats
+
+    spec            A dictionary, list, or value to normalize
+    """
+    if isinstance(spec, dict):
+        return tuple(sorted((str(key), normalize_spec(value)) for key, value in spec.items()))
+    if isinstance(spec, (list, tuple)):
+        return tuple(normalize_spec(value) for value in spec)
+    if isinstance(spec, (int, float, np.number)) and not isinstance(spec, bool):
+        return float(spec)
+    return spec
+
 ################################################################################
 ################################################################################
 # Functions to format plots
@@ -710,12 +2484,15 @@ def add_std_title(plt_dict, plt_title, data):
 
 ################################################################################
 
-def add_std_legend(ax, data, x_key):
+def add_std_legend(ax, data, x_key, n_pts=None):
     """
     Adds in standard information to this subplot's legend, as appropriate
+    If n_pts is given, it is used as the number of points instead of len(data)
     """
+    if isinstance(n_pts, type(None)):
+        n_pts = len(data[x_key])
     # Add legend to report the total number of points and notes on the data
-    n_pts_patch  = mpl.patches.Patch(color='none', label=str(len(data[x_key]))+' points')
+    n_pts_patch  = mpl.patches.Patch(color='none', label=str(n_pts)+' points')
     notes_string = ''.join(data.notes.unique())
     notes_patch  = mpl.patches.Patch(color='none', label=notes_string)
     # Only add the notes_string if it contains something
@@ -806,7 +2583,7 @@ def plot_data(ax, data, plt_dict, fig, ax_pos):
         #   then find the resolution (first differences in dates)
         data = find_date_res(data)
         # Make sure to convert the datetime objects to numbers for plotting
-        res = data['res'].astype('timedelta64[h]')
+        res = (data['res'] // pd.Timedelta(hours=1)).astype(float)
         # Find overall statistics
         median  = np.median(res)
         mean    = np.mean(res)
@@ -984,6 +2761,145 @@ def plot_data(ax, data, plt_dict, fig, ax_pos):
     #
     return xlabel, ylabel, plt_title, ax
 
+################################################################################
+
+# The plot types and colormaps which can be drawn one batch of data at a time
+stream_plot_types = ['T-S']
+stream_clr_maps = ['clr_all_same', 'clr_by_source', 'clr_by_instrmt', 'density_hist']
+# The number of bins of the density histograms drawn in batches. The bins have
+#   to be set before seeing any of the data, so density histograms are only
+#   drawn in batches when the 'S_range' and 'T_range' filters give the ranges
+stream_hist_bins = 250
+
+def use_streaming(plt_dict):
+    """
+    Checks whether a subplot can be drawn one batch of data at a time
+    Returns True or False
+
+    plt_dict        A dictionary containing the info to create this subplot
+    """
+    if plt_dict['color_map'] == 'density_hist':
+        # All the points must fall inside the bins, which come from the filters
+        use_these_filters, white_list = find_filters(plt_dict)
+        if isinstance(use_these_filters, type(None)) or 'S_range' not in use_these_filters.keys() or 'T_range' not in use_these_filters.keys():
+            return False
+    return plt_dict['plot_type'] in stream_plot_types and plt_dict['color_map'] in stream_clr_maps
+
+def plot_data_batches(ax, batches, plt_dict, fig, ax_pos):
+    """
+    Plots data one batch at a time, so that only one batch is in memory at once.
+    Gives the same plots as `plot_data`, except that density histograms use
+    stream_hist_bins bins across the 'S_range' and 'T_range' filters, and
+    instruments are given colors in the order they are loaded
+
+    ax              The axis on which to make the plot
+    batches         An iterable of pandas dataframes of pre-filtered data, such
+                    as from `iter_load_data`
+    plt_dict        A dictionary containing the info to create this subplot
+    fig             The figure in which ax is contained
+    ax_pos          A tuple of the ax (rows, cols, linear number of this subplot)
+    """
+    clr_map   = plt_dict['color_map']
+    # Set the x and y axis labels
+    xlabel, ylabel = r'Salinity (g/kg)', r'Temperature ($^\circ$C)'
+    # Set the title
+    plt_title = 'T-S'
+    # Set the keys for x and y data arrays
+    x_key = 'salt'
+    y_key = 'temp'
+    # The colors are decided before seeing all the data, so find every source
+    #   that could be plotted, in the same order as `plot_data`
+    sources_to_plot = []
+    for source in plt_dict['data_sources']:
+        if not source[0] in sources_to_plot:
+            sources_to_plot.append(source[0])
+    # Instruments are added as they are loaded
+    instrmts_to_plot = []
+    if clr_map == 'density_hist':
+        # The filters set the ranges of the bins (see `use_streaming`), so all
+        #   the points fall inside them
+        use_these_filters, white_list = find_filters(plt_dict)
+        x_range = use_these_filters['S_range']
+        y_range = use_these_filters['T_range']
+        x_edges = np.linspace(min(x_range), max(x_range), stream_hist_bins+1)
+        y_edges = np.linspace(min(y_range), max(y_range), stream_hist_bins+1)
+        counts  = np.zeros((stream_hist_bins, stream_hist_bins))
+    # Keep track of the number of points of each source or instrument, and the
+    #   sources and notes for the title and legend
+    n_pts = {}
+    summaries = []
+    for data in batches:
+        summaries.append(data[['source', 'notes']].drop_duplicates())
+        if clr_map == 'clr_all_same':
+            # Plot every point the same color, size, and marker
+            ax.scatter(data[x_key], data[y_key], color=std_clr, s=mrk_size, marker=std_marker, alpha=mrk_alpha)
+            n_pts['all'] = n_pts.get('all', 0) + len(data)
+        elif clr_map == 'clr_by_source':
+            for source in data.source.unique():
+                i = sources_to_plot.index(source)
+                # Decide on the color, don't go off the end of the array
+                my_clr = mpl_clrs[i%len(mpl_clrs)]
+                this_source = data.source == source
+                ax.scatter(data[this_source][x_key], data[this_source][y_key], color=my_clr, s=mrk_size, marker=std_marker, alpha=mrk_alpha, zorder=(i+1))
+                n_pts[source] = n_pts.get(source, 0) + this_source.sum()
+        elif clr_map == 'clr_by_instrmt':
+            for instrmt in data.instrmt.unique():
+                if not instrmt in instrmts_to_plot:
+                    instrmts_to_plot.append(instrmt)
+                i = instrmts_to_plot.index(instrmt)
+                # Decide on the color, don't go off the end of the array
+                my_clr = mpl_clrs[i%len(mpl_clrs)]
+                this_instrmt = data.instrmt == instrmt
+                ax.scatter(data[this_instrmt][x_key], data[this_instrmt][y_key], color=my_clr, s=mrk_size, marker=std_marker, alpha=mrk_alpha)
+                n_pts[instrmt] = n_pts.get(instrmt, 0) + this_instrmt.sum()
+        elif clr_map == 'density_hist':
+            # Add this batch to the counts of the 2D histogram
+            counts += np.histogram2d(data[x_key], data[y_key], bins=[x_edges, y_edges])[0]
+            n_pts['all'] = n_pts.get('all', 0) + len(data)
+        else:
+            # Did not provide a valid colormap
+            print('Colormap',clr_map,'not valid')
+            exit(0)
+    if len(summaries) == 0:
+        print('No profiles loaded, aborting script')
+        exit(0)
+    summary = pd.concat(summaries)
+    # Add the title and legend now that all the data has been plotted
+    if clr_map == 'clr_by_source':
+        lgnd_hndls = []
+        for i in range(len(sources_to_plot)):
+            my_clr = mpl_clrs[i%len(mpl_clrs)]
+            n_pts_string = ' '+str(n_pts.get(sources_to_plot[i], 0))+' points'
+            lgnd_hndls.append(mpl.patches.Patch(color=my_clr, label=sources_to_plot[i]+n_pts_string))
+        # Add legend with custom handles
+        lgnd = ax.legend(handles=lgnd_hndls)
+    elif clr_map == 'clr_by_instrmt':
+        lgnd_hndls = []
+        # List the instruments in the legend in the same order as `plot_data`
+        for instrmt in np.unique(instrmts_to_plot):
+            i = instrmts_to_plot.index(instrmt)
+            my_clr = mpl_clrs[i%len(mpl_clrs)]
+            n_pts_string = ' '+str(n_pts[instrmt])+' points'
+            lgnd_hndls.append(mpl.patches.Patch(color=my_clr, label=instrmt+n_pts_string))
+        # Add legend with custom handles
+        lgnd = ax.legend(handles=lgnd_hndls)
+    else:
+        if clr_map == 'density_hist':
+            # Decide on what the limits of the colorbar should be
+            clr_min = 0
+            clr_max = 20
+            clr_ext = 'max'        # adds arrow indicating values go past the bounds
+            # Draw the 2D histogram the same way as `hist2d`
+            heatmap = ax.pcolormesh(x_edges, y_edges, counts.T, cmap=cmap_den_h, vmin=clr_min, vmax=clr_max)
+            cbar = plt.colorbar(heatmap, ax=ax, extend=clr_ext)
+            cbar.set_label('density of points')
+        # Add title
+        plt_title = add_std_title(plt_dict, plt_title, summary)
+        # Add legend
+        add_std_legend(ax, summary, x_key, n_pts['all'])
+    #
+    return xlabel, ylabel, plt_title, ax
+
 ################################################################################
 ################################################################################
 # Functions to make other kinds of plots
@@ -1044,48 +2960,10 @@ def plot_arctic_map(ax, data, plt_dict, plt_title, fig, ax_pos):
     #
     # Remove rows of the data frame with missing data for lon and lat
     data = data[data.lon.notnull() & data.lat.notnull()]
-    # Create blank dataframe in which to collect profile info
-    map_df = pd.DataFrame({'source':[], 'instrmt':[], 'prof_no':[], 'lon':[], 'lat':[], 'date':[]})
-    # Get the unique profiles from the data for each instrument
-    unique_instrmts = np.unique(np.array(data['instrmt']))
-    for instrmt in unique_instrmts:
-        # print('For instrument:',instrmt, type(instrmt))
-        instrmt_df = data[data['instrmt'] == instrmt]
-        # print(instrmt_df)
-        pfs_to_plot = np.unique(np.array(instrmt_df['prof_no']))
-        for prof_no in pfs_to_plot:
-            # Get the longitude and latitude values
-            pf_df_lon = instrmt_df[instrmt_df['prof_no']==prof_no].lon
-            pf_df_lat = instrmt_df[instrmt_df['prof_no']==prof_no].lat
-            # Just in case one profile has multiple lat and lon values
-            lon = np.average(np.unique(np.array(pf_df_lon, dtype=float)))
-            lat = np.average(np.unique(np.array(pf_df_lat, dtype=float)))
-            # Get the source, date, format, and notes values
-            pf_df_sou = instrmt_df[instrmt_df['prof_no']==prof_no].source
-            pf_df_date= instrmt_df[instrmt_df['prof_no']==prof_no].date
-            pf_df_form= instrmt_df[instrmt_df['prof_no']==prof_no].format
-            pf_df_note= instrmt_df[instrmt_df['prof_no']==prof_no].notes
-            # Just take the source, date, format, and notes values from
-            #   the first entry, close enough
-            source = np.unique(np.array(pf_df_sou))[0]
-            date   = np.unique(np.array(pf_df_date))[0]
-            format = np.unique(np.array(pf_df_form))[0]
-            notes  = np.unique(np.array(pf_df_note))[0]
-            # Add values to a dictionary
-            pf_dict = {'source': source,
-                       'instrmt': instrmt,
-                       'prof_no': prof_no,
-                       'lon': lon,
-                       'lat': lat,
-                       'date': date,
-                       'format': format,
-                       'notes': notes
-                      }
-            #
-            # Add to the list of profile dataframes
-            map_df = map_df.append(pf_dict, ignore_index=True)
-        #
-    #
+    # Make a data frame with one row per profile
+    map_df, measurements = split_profiles(data)
+    # Get the unique instruments
+    unique_instrmts = np.unique(np.array(map_df['instrmt']))
     clr_map = plt_dict['color_map']
     # Determine the color mapping to be used
     if clr_map == 'clr_all_same':
@@ -1293,6 +3171,8 @@ def find_p_res(data):
     """
     Finds the difference between each sequential pressure measurement in each
     profile in the data and stores it as a new column called 'res'
+    Returns the data sorted by instrmt, prof_no, and p, without the first
+    measurement of each profile
 
     df      A pandas DataFrame with the following columns:
         instrmt     A string of the instrmt name that took the profile
@@ -1301,42 +3181,52 @@ def find_p_res(data):
         salt        An array of salinity values
         p           An array of depth values (in m)
     """
-    # Add a new column for the resolution values
-    data['res'] = None
-    # Create an empty list to add each modified profile to
-    output_list = []
-    # Loop across each instrument
-    instrmts = np.unique(np.array(data['instrmt']))
-    for instrmt in instrmts:
-        # Find the data for just that instrument
-        data_instrmt = data[data.instrmt == instrmt]
-        # Loop across each profile
-        pfs = np.unique(np.array(data['prof_no']))
-        for pf in pfs:
-            # Find the data just for that profile
-            data_pf = data_instrmt[data_instrmt.prof_no == pf]
-            # Sort that profile by the pressure (depth) values
-            data_sorted = data_pf.sort_values(by='p')
-            # Add first difference of depth values to data frame
-            data_sorted['res'] = abs(data_sorted['p'].diff())
-            # Add that dataframe to the list
-            output_list.append(data_sorted)
-        #
-    #
-    # Combine all the modified profile data frames into one
-    data = pd.concat(output_list)
+    # Sort first by instrmt, then prof_no, then p, all in one go. The profile
+    #   numbers are text, so they sort the same way as `np.unique` would
+    instrmt_codes = find_sorted_codes(data['instrmt'])
+    prof_no_codes = find_sorted_codes(data['prof_no'])
+    p = np.asarray(data['p'], dtype=float)
+    order = np.lexsort((p, prof_no_codes, instrmt_codes))
+    data = data.iloc[order]
+    instrmt_codes = instrmt_codes[order]
+    prof_no_codes = prof_no_codes[order]
+    p = p[order]
+    # Take the first difference of the depth values, except across the start
+    #   of each profile
+    res = np.abs(np.diff(p, prepend=np.nan))
+    new_pf = np.ones(len(p), dtype=bool)
+    new_pf[1:] = (instrmt_codes[1:] != instrmt_codes[:-1]) | (prof_no_codes[1:] != prof_no_codes[:-1])
+    res[new_pf] = np.nan
+    # Add a new column for the resolution values, without changing the original
+    #   data frame, which may be shared with other subplots
+    data = data.assign(res=res)
     # Remove rows of the data frame with missing data
     #   Note: only apply to res because 'format' will often be
     #       set to a null value, for exmaple with AIDJEX data
     data = data[data.res.notnull()]
     return data
 
+def find_sorted_codes(values):
+    """
+    Numbers each distinct value in a column, in sorted order, so that sorting
+    the numbers sorts the values. Works without making a Python object for
+    every row when the column is a categorical
+    Returns an array of integer codes
+
+    values          A pandas series
+    """
+    values = values.astype('category')
+    values = values.cat.reorder_categories(sorted(values.cat.categories))
+    return np.asarray(values.cat.codes)
+
 ################################################################################
 
 def find_date_res(data):
     """
     Finds the difference between each sequential date measurement of each
     profile in the data and stores it as a new column called 'res'
+    Returns a pandas dataframe with one row per profile, sorted by instrmt and
+    date, without the first profile of each instrument
 
     df      A pandas DataFrame with the following columns:
         instrmt     A string of the instrmt name that took the profile
@@ -1345,58 +3235,28 @@ def find_date_res(data):
         salt        An array of salinity values
         p           An array of depth values (in m)
     """
-    # Create an empty list to add each modified profile to
-    output_list = []
-    # Get the unique profiles from the data for each instrument
-    unique_instrmts = np.unique(np.array(data['instrmt']))
-    for instrmt in unique_instrmts:
-        # Create blank dataframe in which to collect profile info
-        date_df = pd.DataFrame({'source':[], 'instrmt':[], 'prof_no':[], 'date':[], 'res':[], 'format':[], 'notes':[]})
-        # print('For instrument:',instrmt, type(instrmt))
-        instrmt_df = data[data['instrmt'] == instrmt]
-        # print(instrmt_df)
-        pfs_to_plot = np.unique(np.array(instrmt_df['prof_no']))
-        for prof_no in pfs_to_plot:
-            # print('    For profile:',prof_no, type(prof_no))
-            # Get the source, date, format, and notes values
-            pf_df_sou = instrmt_df[instrmt_df['prof_no']==prof_no].source
-            pf_df_date= instrmt_df[instrmt_df['prof_no']==prof_no].date
-            pf_df_form= instrmt_df[instrmt_df['prof_no']==prof_no].format
-            pf_df_note= instrmt_df[instrmt_df['prof_no']==prof_no].notes
-            # Just take the source, date, format, and notes values from
-            #   the first entry, close enough
-            source = np.unique(np.array(pf_df_sou))[0]
-            date   = np.unique(np.array(pf_df_date))[0]
-            format = np.unique(np.array(pf_df_form))[0]
-            notes  = np.unique(np.array(pf_df_note))[0]
-            # Add values to a dictionary
-            pf_dict = {'source': source,
-                       'instrmt': instrmt,
-                       'prof_no': prof_no,
-                       'date': date,
-                       'res': None,
-                       'format': format,
-                       'notes': notes
-                      }
-            #
-            # Add to the list of profile dataframes
-            date_df = date_df.append(pf_dict, ignore_index=True)
-        #
-        # Sort that instrument's dataframe by the date values
-        data_sorted = date_df.sort_values(by=['date'])
-        # Add first difference of date values to data frame
-        data_sorted['res'] = abs(data_sorted['date'].diff())
-        # Add that dataframe to the list
-        output_list.append(data_sorted)
-    #
-    # Combine all the modified profile data frames into one
-    df = pd.concat(output_list)
+    # Take the source, date, format, and notes values of each profile
+    profiles, measurements = split_profiles(data)
+    df = profiles[['source', 'instrmt', 'prof_no', 'date', 'format', 'notes']]
+    # Sort first by instrmt, then by date, with any missing dates last
+    instrmt_codes = find_sorted_codes(df['instrmt'])
+    prof_no_codes = find_sorted_codes(df['prof_no'])
+    dates = np.asarray(df['date'], dtype='datetime64[ns]')
+    order = np.lexsort((prof_no_codes, dates, np.isnat(dates), instrmt_codes))
+    df = df.iloc[order].reset_index(drop=True)
+    instrmt_codes = instrmt_codes[order]
+    dates = dates[order]
+    # Take the first difference of date values, except across the start of
+    #   each instrument
+    res = np.abs(np.diff(dates, prepend=np.datetime64('NaT')))
+    new_instrmt = np.ones(len(dates), dtype=bool)
+    new_instrmt[1:] = instrmt_codes[1:] != instrmt_codes[:-1]
+    res[new_instrmt] = np.timedelta64('NaT')
+    df.insert(4, 'res', res)
     # Remove rows of the data frame with missing data
     #   Note: only apply to res because 'format' will often be
     #       set to a null value, for exmaple with AIDJEX data
     df = df[df.res.notnull()]
-    # print(df)
-    # exit(0)
     return df
 
 ################################################################################
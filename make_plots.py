@@ -191,5 +191,8 @@ to_plot = [
 
 ################################################################################
 # Main execution of code
+#   Note: the check on __name__ is needed so that the processes used to read in
+#       data files in parallel (workers > 1) don't run this script again
 
-hf.make_plots(to_plot, filename=None)
+if __name__ == '__main__':
+    hf.make_plots(to_plot, filename=None, workers=None)